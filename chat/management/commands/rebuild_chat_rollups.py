@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+from mongo_chat_platform.services.logging_service import ConversationLogger, to_naive_utc
+
+
+class Command(BaseCommand):
+    help = "Recomputes the hourly chat log rollups from raw chat_logs (backfill or repair)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', default=None,
+                            help="Only rebuild buckets from this ISO datetime on (UTC unless it has an offset). Rebuilds everything when omitted.")
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            try:
+                since = parse_datetime(options['since'])
+            except ValueError:
+                since = None
+            if since is None:
+                raise CommandError(f"Invalid --since datetime: {options['since']}")
+            since = to_naive_utc(since)
+
+        try:
+            ConversationLogger().rebuild_rollups(since)
+        except Exception as e:
+            raise CommandError(f"Rollup rebuild failed: {e}")
+        self.stdout.write(self.style.SUCCESS("Chat log rollups rebuilt."))
@@ -0,0 +1,59 @@
+import time
+from concurrent.futures import wait
+from django.core.management.base import BaseCommand, CommandError
+from mongo_chat_platform.services.indexing_service import SchemaIndexer
+
+
+class Command(BaseCommand):
+    help = "(Re)indexes MongoDB database schemas into ChromaDB, once or periodically."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--uri', action='append', default=[],
+                            help="MongoDB connection URI to index. Repeat for several clusters.")
+        parser.add_argument('--db', action='append', default=[],
+                            help="Database name to index on every URI. Defaults to the URI's default database.")
+        parser.add_argument('--interval', type=int, default=0,
+                            help="Re-index every N seconds. Runs once when omitted.")
+        parser.add_argument('--workers', type=int, default=None,
+                            help="Maximum concurrent indexing jobs (SCHEMA_INDEX_WORKERS).")
+        parser.add_argument('--max-per-cluster', type=int, default=None,
+                            help="Maximum concurrent indexing jobs per cluster (SCHEMA_INDEX_MAX_PER_CLUSTER).")
+
+    def handle(self, *args, **options):
+        uris = options['uri']
+        if not uris:
+            raise CommandError("At least one --uri is required.")
+        db_names = options['db'] or [None]
+
+        # The command drives its own loop, so the in-process scheduler stays off
+        indexer = SchemaIndexer(
+            max_workers=options['workers'],
+            max_per_cluster=options['max_per_cluster'],
+            refresh_interval=0,
+        )
+        targets = [(uri, db_name) for uri in uris for db_name in db_names]
+
+        while True:
+            started = time.monotonic()
+            futures = [indexer.submit(uri, db_name, on_progress=self.report_progress) for uri, db_name in targets]
+            wait(futures)
+
+            failed = [f.result() for f in futures if f.result().get('state') == 'failed']
+            elapsed = time.monotonic() - started
+            summary = f"Indexed {len(futures) - len(failed)}/{len(futures)} databases in {elapsed:.1f}s"
+            self.stdout.write(self.style.SUCCESS(summary) if not failed else self.style.WARNING(summary))
+
+            if not options['interval']:
+                if failed:
+                    raise CommandError(f"{len(failed)} database(s) failed to index.")
+                return
+            time.sleep(max(0, options['interval'] - elapsed))
+
+    def report_progress(self, key, status):
+        state = status.get('state')
+        if state == 'failed':
+            self.stderr.write(f"[{key}] failed: {status.get('error')}")
+        elif state == 'done':
+            self.stdout.write(f"[{key}] done ({status.get('total')} collections)")
+        else:
+            self.stdout.write(f"[{key}] {status.get('indexed')}/{status.get('total')} collections")
@@ -1,3 +1,135 @@
-from django.test import TestCase
+import datetime
+import json
+from bson import ObjectId
+from django.test import SimpleTestCase
+from unittest import mock
+from mongo_chat_platform.services.query_plan_service import MAX_FIND_LIMIT, QueryCompileError, QueryPlanCompiler
+from mongo_chat_platform.services.result_summary_service import format_documents
 
-# Create your tests here.
+COLLECTIONS = ["orders", "users"]
+SCHEMA = {"orders": {"status": "string", "createdAt": "date", "userId": "objectId", "total": "double"}}
+
+
+class QueryPlanCompilerTests(SimpleTestCase):
+    def setUp(self):
+        self.compiler = QueryPlanCompiler()
+
+    def compile(self, tool_input, schema=SCHEMA):
+        return self.compiler.compile(tool_input, COLLECTIONS, schema)
+
+    def test_rejects_nested_write_and_javascript_operators(self):
+        queries = [
+            ("aggregate", [{"$match": {"status": "paid"}}, {"$out": "copy"}]),
+            ("aggregate", [{"$facet": {"a": [{"$merge": {"into": "copy"}}]}}]),
+            ("aggregate", [{"$lookup": {"from": "users", "as": "u", "pipeline": [{"$out": "copy"}]}}]),
+            ("aggregate", [{"$project": {"x": {"$function": {"body": "return 1", "args": [], "lang": "js"}}}}]),
+            ("find", {"$or": [{"status": "paid"}, {"$where": "this.total > 1"}]}),
+            ("find", {"$expr": {"$gt": [{"$accumulator": {}}, 1]}}),
+        ]
+        for action, query in queries:
+            with self.subTest(query=query), self.assertRaises(QueryCompileError):
+                self.compile({"collection": "orders", "action": action, "query": query})
+
+    def test_rejects_invalid_input(self):
+        invalid = [
+            "not json",
+            {"collection": "missing", "action": "find", "query": {}},
+            {"collection": "orders", "action": "delete", "query": {}},
+            {"collection": "orders", "action": "aggregate", "query": {"status": "paid"}},
+            {"collection": "orders", "action": "aggregate", "query": [{"$unknownStage": {}}]},
+            {"collection": "orders", "action": "find", "query": {"$or": ["paid"]}},
+            {"collection": "orders", "action": "find", "query": {"$and": {"status": "paid"}}},
+            {"collection": "orders", "action": "distinct", "query": {}},
+            {"collection": "orders", "action": "find", "query": {}, "limit": "many"},
+        ]
+        for tool_input in invalid:
+            with self.subTest(tool_input=tool_input), self.assertRaises(QueryCompileError):
+                self.compile(tool_input)
+
+    def test_coerces_extended_json(self):
+        oid = "64b7f0c2a1b2c3d4e5f60718"
+        plan = self.compile({"collection": "orders", "action": "find", "query": {
+            "userId": {"$oid": oid},
+            "createdAt": {"$gte": {"$date": "2024-01-01T00:00:00Z"}},
+        }})
+        self.assertEqual(plan.query["userId"], ObjectId(oid))
+        self.assertEqual(plan.query["createdAt"]["$gte"],
+                         datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc))
+
+    def test_coerces_literals_to_schema_types(self):
+        oid = "64b7f0c2a1b2c3d4e5f60718"
+        plan = self.compile({"collection": "orders", "action": "aggregate", "query": [
+            {"$match": {"userId": oid, "createdAt": {"$lt": "2024-02-01"}, "status": "2024-02-01"}},
+        ]})
+        match = plan.query[0]["$match"]
+        self.assertEqual(match["userId"], ObjectId(oid))
+        self.assertEqual(match["createdAt"]["$lt"], datetime.datetime(2024, 2, 1))
+        # String fields keep string literals, even date-like ones
+        self.assertEqual(match["status"], "2024-02-01")
+
+    def test_clamps_limit(self):
+        cases = [(None, 5), (0, 5), (-3, 1), (7, 7), (10_000, MAX_FIND_LIMIT)]
+        for limit, expected in cases:
+            with self.subTest(limit=limit):
+                plan = self.compile({"collection": "orders", "action": "find", "query": {}, "limit": limit})
+                self.assertEqual(plan.limit, expected)
+
+    def test_warns_on_unknown_fields(self):
+        plan = self.compile({"collection": "orders", "action": "find", "query": {"stauts": "paid"}})
+        self.assertEqual(len(plan.warnings), 1)
+        self.assertIn("stauts", plan.warnings[0])
+
+    def test_cache_hits_return_independent_copies(self):
+        tool_input = {"collection": "orders", "action": "find", "query": {"status": "paid"}, "projection": {"total": 1}}
+        first = self.compile(tool_input)
+        first.query["injected"] = 1
+        first.projection["injected"] = 1
+
+        second = self.compile(tool_input)
+        self.assertEqual(second.fingerprint, first.fingerprint)
+        self.assertEqual(second.query, {"status": "paid"})
+        self.assertEqual(second.projection, {"total": 1})
+
+    def test_cache_is_bounded_and_keyed_by_schema(self):
+        compiler = QueryPlanCompiler(cache_size=2)
+        for status in ("a", "b", "c"):
+            compiler.compile({"collection": "orders", "action": "find", "query": {"status": status}}, COLLECTIONS, SCHEMA)
+        self.assertEqual(len(compiler._cache), 2)
+
+        tool_input = {"collection": "orders", "action": "find", "query": {"createdAt": "2024-01-01"}}
+        typed = self.compile(tool_input)
+        untyped = self.compile(tool_input, schema={})
+        self.assertNotEqual(typed.fingerprint, untyped.fingerprint)
+        self.assertIsInstance(typed.query["createdAt"], datetime.datetime)
+        self.assertEqual(untyped.query["createdAt"], "2024-01-01")
+
+
+@mock.patch.dict("os.environ", {"RESULT_SUMMARY_MAX_CHARS": "4000"})
+class FormatDocumentsTests(SimpleTestCase):
+    def test_small_results_are_raw_json(self):
+        docs = [{"name": f"Co {i}", "revenue": 1000 * i} for i in range(5)]
+        self.assertEqual(json.loads(format_documents(docs, "find", 5)), docs)
+
+    def test_top_five_keeps_every_row_over_budget(self):
+        docs = [{"name": f"Co {i}", "revenue": 1000 * i, "bio": "x" * 2000} for i in range(5)]
+        formatted = format_documents(docs, "find", 5)
+        self.assertLessEqual(len(formatted), 4000)
+        for i in range(5):
+            self.assertIn(f'"revenue": {1000 * i}', formatted)
+        self.assertNotIn("omitted", formatted)
+
+    def test_wide_results_stay_within_budget(self):
+        docs = [{f"field_{j}": f"value {i} " + "x" * (20 + j * 2) for j in range(31)} for i in range(20)]
+        self.assertGreater(len(json.dumps(docs)), 4000)
+        for action in ("find", "aggregate"):
+            with self.subTest(action=action):
+                formatted = format_documents(docs, action, 20)
+                self.assertLessEqual(len(formatted), 4000)
+                self.assertRegex(formatted, r"\d+ more rows omitted")
+
+    def test_aggregate_output_gets_no_statistics(self):
+        docs = [{"_id": f"status-{i}", "count": i, "note": "y" * 500} for i in range(10)]
+        formatted = format_documents(docs, "aggregate")
+        self.assertNotIn("documents,", formatted)
+        for i in range(10):
+            self.assertIn(f'"count": {i}', formatted)
@@ -5,4 +5,10 @@ app_name = 'chat'
 
 urlpatterns = [
     path('interface/', views.chat_interface, name='interface'),
+    path('history/', views.chat_history_page, name='history'),
+    path('index-status/', views.index_status, name='index_status'),
+    path('llm-metrics/', views.llm_metrics, name='llm_metrics'),
+    path('export/', views.export_results, name='export'),
+    path('cancel/', views.cancel_operations, name='cancel'),
+    path('analytics/', views.analytics, name='analytics'),
 ]
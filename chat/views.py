@@ -1,12 +1,24 @@
 from django.shortcuts import render, redirect
 from django.contrib import messages
-from mongo_chat_platform.services.mongo_service import MongoService
+from mongo_chat_platform.services.mongo_service import MongoService, query_limits
 from mongo_chat_platform.services.chroma_service import ChromaService
-from mongo_chat_platform.services.llm_service import LLMService
-from mongo_chat_platform.services.logging_service import ConversationLogger
+from mongo_chat_platform.services.llm_service import LLMService, get_llm_metrics
+from mongo_chat_platform.services.logging_service import ConversationLogger, to_naive_utc
+from mongo_chat_platform.services.memory_service import ConversationMemory
+from mongo_chat_platform.services.indexing_service import get_schema_indexer
+from mongo_chat_platform.services.query_plan_service import QueryCompileError, compile_query, schema_types
+from mongo_chat_platform.services.export_service import EXPORT_FORMATS, stream_export
 from mongo_chat_platform.logger import logger
-from django.http import JsonResponse
+from django.http import HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.contrib.admin.views.decorators import staff_member_required
+from django.utils.dateparse import parse_datetime
+import hashlib
 import json
+import os
+from datetime import datetime, timedelta
+
+def chat_page_size():
+    return int(os.getenv("CHAT_PAGE_SIZE", "20"))
 
 def chat_interface(request):
     # 1. Check Session
@@ -20,29 +32,25 @@ def chat_interface(request):
     
     # Initialize Services
     try:
-        mongo_service = MongoService(mongo_uri, db_name)
+        mongo_service = MongoService(mongo_uri, db_name, op_tag=request.session.session_key)
         # Note: In a real app, instantiate services as singletons or carefully to avoid overhead
         chroma_service = ChromaService()
         llm_service = LLMService()
         logger_service = ConversationLogger()
+        memory = ConversationMemory()
     except Exception as e:
         logger.critical(f"Service initialization failed: {e}")
         messages.error(request, f"Service Initialization Failed: {str(e)}")
         return redirect('connect:home')
 
-    # 2. Indexing (If not done for this session)
+    # 2. Indexing (Runs in the background, never on the request path)
     if not request.session.get('is_indexed'):
-        try:
-            logger.info("Starting schema indexing...")
-            schema_info = mongo_service.extract_schema_info()
-            for col_name, schema in schema_info.items():
-                chroma_service.store_schema(db_name, col_name, schema)
+        index_status = get_schema_indexer().ensure_indexed(mongo_uri, db_name) or {}
+        if index_status.get('state') == 'done':
             request.session['is_indexed'] = True
-            logger.info("Schema indexing completed")
-            messages.success(request, "Database schema indexed successfully!")
-        except Exception as e:
-            logger.error(f"Schema indexing failed: {e}")
-            messages.warning(request, f"Indexing failed: {str(e)}. Chat may be less accurate.")
+        elif index_status.get('state') == 'failed':
+            logger.error(f"Schema indexing failed: {index_status.get('error')}")
+            messages.warning(request, f"Indexing failed: {index_status.get('error')}. Chat may be less accurate.")
 
     # 3. Handle Chat Interaction
     chat_history = request.session.get('chat_history', [])
@@ -64,8 +72,8 @@ def chat_interface(request):
             # Note: We append to the session history at the end
             
             # RAG Retrieval (Schema)
-            context_docs = chroma_service.retrieve_context(user_query, db_name=db_name, n_results=15)
-            context_str = "\n".join([f"Collection: {meta['collection_name']}\nSchema Sample: {doc}" for doc, meta in context_docs])
+            context_docs = chroma_service.retrieve_context(user_query, db_name=db_name)
+            context_str = "\n".join([f"Collection: {meta['collection_name']}\nRelevant Fields:\n{doc}" for doc, meta in context_docs])
             
             # RAG Retrieval (History)
             similar_chats = chroma_service.retrieve_chat_history(user_query, request.session.session_key)
@@ -117,25 +125,41 @@ def chat_interface(request):
             
             logger.info(f"Generating LLM response for query: {user_query}")
             
-            # Simple conversation history formatting for LLM
-            llm_history = [{"role": m['role'], "content": m['content']} for m in chat_history] 
+            # Conversation history for the LLM: running summary + recent raw turns
+            memory_state = memory.get_state(request.session.session_key)
+            llm_history = memory.build_history(chat_history, memory_state)
             
             # 1. First Pass: Get Initial Response (Potential Tool Call)
-            response = llm_service.generate_response(system_prompt, user_query, llm_history)
+            response, truncated = llm_service.generate_draft(system_prompt, user_query, llm_history, stage="tool")
             
             # 2. Check for Tool Execution
             import re
             tool_match = re.search(r'<<<QUERY>>>(.*?)<<<END_QUERY>>>', response, re.DOTALL)
+            if not tool_match and truncated:
+                # A no-tool answer cut off at the tool stage's token budget: ask the answer model instead.
+                # It may still decide to use the tool, so its response goes through the same detection
+                response = llm_service.generate_response(system_prompt, user_query, llm_history, stage="answer")
+                tool_match = re.search(r'<<<QUERY>>>(.*?)<<<END_QUERY>>>', response, re.DOTALL)
             
+            tool_action = None
+            tool_error = False
             if tool_match:
+                tool_action = 'unknown'
                 try:
                     tool_json_str = tool_match.group(1).strip()
                     logger.info(f"Tool Call Detected: {tool_json_str}")
-                    tool_input = json.loads(tool_json_str)
+                    # Compile: parse, validate and normalize before touching the database
+                    plan = compile_query(tool_json_str, mongo_service.get_collection_names(), schema_types(db_name))
                     
+                    # Remember the validated plan so its full result can be exported
+                    request.session['last_query_plan'] = plan.to_dict()
+
+                    tool_action = plan.action
+
                     # Execute Tool
-                    tool_result = mongo_service.execute_tool_query(tool_input)
+                    tool_result = mongo_service.execute_tool_query(plan)
                     logger.info(f"Tool Result: {tool_result}")
+                    tool_error = tool_result.startswith(("Error:", "Database Error:"))
                     
                     # Append execution to history context for final answer
                     # We simulate a "System" or "Tool" role interaction for the LLM context
@@ -145,20 +169,25 @@ def chat_interface(request):
                     ]
                     
                     # 3. Second Pass: Get Final Answer based on Data
-                    final_response = llm_service.generate_response(system_prompt, user_query, llm_history + tool_interaction)
+                    final_response = llm_service.generate_response(system_prompt, user_query, llm_history + tool_interaction, stage="answer")
                     response = final_response # Override response with the actual answer
                     
-                except json.JSONDecodeError:
-                    logger.error("Failed to parse tool JSON")
-                    response += "\n(System: Failed to execute query due to invalid JSON format)"
+                except QueryCompileError as e:
+                    logger.error(f"Failed to compile tool query: {e}")
+                    tool_error = True
+                    response += f"\n(System: Failed to execute query: {str(e)})"
                 except Exception as e:
                     logger.error(f"Tool execution loop failed: {e}")
+                    tool_error = True
                     response += f"\n(System: Tool execution error: {str(e)})"
 
             # Update History
             timestamp = datetime.now().strftime("%Y-%m-%d %H:%M")
             chat_history.append({'role': 'user', 'content': user_query, 'timestamp': timestamp})
             chat_history.append({'role': 'assistant', 'content': response, 'timestamp': timestamp})
+
+            # Fold older turns into the running summary (in the background)
+            memory.schedule_fold(request.session.session_key, chat_history, memory_state, llm_service)
             
             # Log Interaction Persistently
             # getting IP
@@ -191,7 +220,8 @@ def chat_interface(request):
                 
             try:
                 # Log to Mongo Logger (Audit)
-                logger_service.log_interaction(ip, request.session.session_key, user_query, response)
+                logger_service.log_interaction(ip, request.session.session_key, user_query, response,
+                                               db_name=db_name, tool_action=tool_action, tool_error=tool_error)
                 
                 # Store in ChromaDB (Vector Memory)
                 chroma_service.store_chat_interaction(user_query, response, request.session.session_key)
@@ -213,8 +243,159 @@ def chat_interface(request):
                     'timestamp': timestamp
                 })
 
+    # Only the most recent turns are rendered; older ones are fetched page by page on scroll
+    history_start = max(0, len(chat_history) - chat_page_size())
     context = {
         'db_name': db_name,
-        'chat_history': chat_history
+        'chat_history': chat_history[history_start:],
+        'history_start': history_start
     }
     return render(request, 'chat/interface.html', context)
+
+def index_status(request):
+    """
+    Reports background schema indexing progress for the current session's database.
+    """
+    mongo_uri = request.session.get('mongo_uri')
+    if not mongo_uri:
+        return JsonResponse({'success': False, 'message': 'No active session'}, status=401)
+
+    db_name = request.session.get('db_name')
+    status = get_schema_indexer().get_status(mongo_uri, db_name)
+    if not status:
+        return JsonResponse({'success': True, 'status': {'state': 'unknown'}})
+
+    if status.get('state') == 'done':
+        request.session['is_indexed'] = True
+    return JsonResponse({'success': True, 'status': status})
+
+def llm_metrics(request):
+    """
+    Exposes LLM scheduler metrics (queue depth, wait times, retries, usage against limits).
+    """
+    if not request.session.get('mongo_uri'):
+        return JsonResponse({'success': False, 'message': 'No active session'}, status=401)
+    return JsonResponse({'success': True, 'metrics': get_llm_metrics()})
+
+def export_results(request):
+    """
+    Streams the full result of the last query the assistant ran, as NDJSON or CSV,
+    straight from the MongoDB cursor (no row cap, no LLM involvement).
+    Query params: format=ndjson|csv, fields=a,b,c (projection), batch_size=N.
+    """
+    mongo_uri = request.session.get('mongo_uri')
+    if not mongo_uri:
+        return JsonResponse({'success': False, 'message': 'No active session'}, status=401)
+
+    plan_dict = request.session.get('last_query_plan')
+    if not plan_dict:
+        return JsonResponse({'success': False, 'message': 'No query to export yet. Ask a data question first.'}, status=404)
+
+    export_format = request.GET.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return JsonResponse({'success': False, 'message': f"Unsupported format '{export_format}'"}, status=400)
+
+    default_batch_size = query_limits('export')[1] or 1000
+    try:
+        batch_size = int(request.GET.get('batch_size', default_batch_size))
+    except ValueError:
+        batch_size = default_batch_size
+    batch_size = max(100, min(batch_size, 10000))
+
+    fields = [f.strip() for f in request.GET.get('fields', '').split(',') if f.strip()]
+    projection = {f: 1 for f in fields} or None
+
+    db_name = request.session.get('db_name')
+    try:
+        mongo_service = MongoService(mongo_uri, db_name, op_tag=request.session.session_key)
+        # Re-validate: the session copy is plain JSON and must pass the same checks as a chat query
+        plan = compile_query(plan_dict, mongo_service.get_collection_names(), schema_types(db_name))
+        if plan.action not in ('find', 'aggregate'):
+            return JsonResponse({'success': False, 'message': f"'{plan.action}' results cannot be exported."}, status=400)
+        # Runs the query and primes the first batch, so query errors become a JSON error, not a truncated file
+        documents = mongo_service.iter_plan_documents(plan, projection=projection, batch_size=batch_size)
+    except QueryCompileError as e:
+        return JsonResponse({'success': False, 'message': str(e)}, status=400)
+    except Exception as e:
+        logger.error(f"Export failed: {e}")
+        return JsonResponse({'success': False, 'message': f"Export failed: {str(e)}"}, status=500)
+
+    response = StreamingHttpResponse(
+        stream_export(documents, export_format, columns=fields or None, chunk_size=batch_size),
+        content_type=EXPORT_FORMATS[export_format]
+    )
+    response['Content-Disposition'] = f'attachment; filename="{plan.collection}.{export_format}"'
+    return response
+
+def cancel_operations(request):
+    """
+    Kills the session's running database operations. Sent by the page when it is closed or
+    navigated away from while a question is still being answered.
+    """
+    mongo_uri = request.session.get('mongo_uri')
+    if request.method != 'POST' or not mongo_uri:
+        return JsonResponse({'success': False}, status=400)
+
+    mongo_service = MongoService(mongo_uri, request.session.get('db_name'), op_tag=request.session.session_key)
+    killed = mongo_service.cancel_operations()
+    return JsonResponse({'success': True, 'cancelled': killed})
+
+@staff_member_required
+def analytics(request):
+    """
+    Usage dashboard data, answered from the hourly chat log rollups.
+    Query params: from/to (ISO datetimes, default last 24h), db (optional database filter).
+    """
+    try:
+        end = parse_datetime(request.GET.get('to', '')) or datetime.utcnow()
+        start = parse_datetime(request.GET.get('from', '')) or end - timedelta(days=1)
+    except ValueError as e:
+        # Well formed but impossible, e.g. month 13
+        return JsonResponse({'success': False, 'message': f"Invalid datetime: {e}"}, status=400)
+    # Rollup buckets are naive UTC
+    start, end = to_naive_utc(start), to_naive_utc(end)
+    db_name = request.GET.get('db') or None
+
+    try:
+        logger_service = ConversationLogger()
+    except Exception as e:
+        return JsonResponse({'success': False, 'message': str(e)}, status=503)
+
+    return JsonResponse({
+        'success': True,
+        'from': start,
+        'to': end,
+        'questions_per_db_hour': logger_service.get_questions_per_db_hour(start, end, db_name),
+        'volume_by_ip': logger_service.get_volume_by_ip(start, end),
+        'tool_errors': logger_service.get_tool_error_rate(start, end, db_name),
+    })
+
+def chat_history_page(request):
+    """
+    Serves older transcript messages: the `limit` messages before index `before`.
+    Pages are conditional (ETag / If-None-Match), so unchanged pages are not re-sent.
+    """
+    if not request.session.get('mongo_uri'):
+        return JsonResponse({'success': False, 'message': 'No active session'}, status=401)
+
+    chat_history = request.session.get('chat_history', [])
+    try:
+        before = int(request.GET.get('before', len(chat_history)))
+        limit = int(request.GET.get('limit', chat_page_size()))
+    except ValueError:
+        return JsonResponse({'success': False, 'message': 'Invalid paging parameters'}, status=400)
+    before = max(0, min(before, len(chat_history)))
+    limit = max(1, min(limit, 100))
+    start = max(0, before - limit)
+
+    payload = {'success': True, 'messages': chat_history[start:before], 'start': start, 'has_more': start > 0}
+    etag = '"%s"' % hashlib.md5(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponseNotModified()
+    else:
+        response = JsonResponse(payload)
+    response['ETag'] = etag
+    # Cached by the browser, but always revalidated
+    response['Cache-Control'] = 'private, no-cache'
+    return response
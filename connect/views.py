@@ -1,10 +1,11 @@
 from django.shortcuts import render, redirect
 from django.contrib import messages
 from .forms import MongoConnectionForm
-from pymongo import MongoClient
 import pymongo
 from django.urls import reverse
 from mongo_chat_platform.logger import logger
+from mongo_chat_platform.services.mongo_service import MongoService, verify_connection
+from mongo_chat_platform.services.indexing_service import get_schema_indexer
 from django.http import JsonResponse
 import json
 
@@ -28,23 +29,22 @@ def connect_view(request):
         if uri:
             try:
                 logger.info(f"Attempting MongoDB connection for URI: {uri.split('@')[-1]}") # Log without credentials
-                # 1. Attempt to connect
-                client = MongoClient(uri, serverSelectionTimeoutMS=5000)
-                # 2. Verify connection by running a ping command
-                client.admin.command('ping')
+                # 1. Connect and verify with a ping (cached briefly, client kept in the shared pool)
+                db_name = verify_connection(uri)
                 logger.info("MongoDB connection verification successful")
                 
-                # 3. Store URI in session (In production, encrypt this!)
+                # 2. Store URI in session (In production, encrypt this!)
                 request.session['mongo_uri'] = uri
-                
-                # 4. Get database name
-                try:
-                    db_name = client.get_default_database().name
-                except:
-                    db_name = None 
-                
                 request.session['db_name'] = db_name
 
+                # 3. Warm the collection catalog and start schema indexing before the chat page loads
+                if db_name:
+                    try:
+                        MongoService(uri, db_name).get_collection_names()
+                        get_schema_indexer().ensure_indexed(uri, db_name)
+                    except Exception as e:
+                        logger.warning(f"Collection catalog prefetch failed: {e}")
+
                 success_msg = f"Successfully connected to MongoDB! {f'Database: {db_name}' if db_name else ''}"
                 
                 if is_ajax:
@@ -1,7 +1,22 @@
 import chromadb
 from chromadb.utils import embedding_functions
 import os
+import threading
 from mongo_chat_platform.logger import logger
+from mongo_chat_platform.services.retrieval_service import (
+    LexicalSchemaIndex, extract_fields, format_field, get_lexical_index, rerank, set_lexical_index,
+)
+from mongo_chat_platform.services.vector_replica import get_replica_store, is_older_generation
+from mongo_chat_platform.services.indexing_service import get_index_status_store
+
+# Chroma limits how many records a single upsert may carry
+UPSERT_BATCH_SIZE = 500
+# Field lines included in the prompt per collection
+MAX_FIELDS_PER_COLLECTION = 15
+
+# Databases whose vector replica is being loaded in the background
+_pending_replicas = set()
+_pending_replica_lock = threading.Lock()
 
 class ChromaService:
     def __init__(self, collection_name="mongo_schema_metadata"):
@@ -58,19 +73,47 @@ class ChromaService:
 
     def store_schema(self, db_name, collection_name, schema_str):
         """
-        Stores validation schema or sample document structure for a collection.
-        ID format: dbname_collectionname
+        Stores the sample document structure of a collection as per-field chunks,
+        so that deeply nested fields of wide documents stay searchable.
+        ID format: dbname_collectionname (collection chunk), dbname_collectionname::field.path (field chunks)
         """
         doc_id = f"{db_name}_{collection_name}"
-        logger.info(f"Storing schema for {doc_id}")
+        fields = extract_fields(schema_str)
+        logger.info(f"Storing schema for {doc_id}: {len(fields)} field chunks")
         metadata = {"db_name": db_name, "collection_name": collection_name}
-        
+
+        top_level = [path for path, _, _ in fields if '.' not in path]
+        ids = [doc_id]
+        documents = [f"Collection: {collection_name}\nFields: {', '.join(top_level)}"]
+        metadatas = [{**metadata, "field_path": ""}]
+        for path, type_name, example in fields:
+            ids.append(f"{doc_id}::{path}")
+            documents.append(f"Collection: {collection_name}\nField: {path}\nType: {type_name}\nExample: {example}")
+            metadatas.append({**metadata, "field_path": path, "field_type": type_name, "example": example})
+
         # Upsert: Update if exists
-        self.collection.upsert(
-            documents=[schema_str],
-            metadatas=[metadata],
-            ids=[doc_id]
-        )
+        for start in range(0, len(ids), UPSERT_BATCH_SIZE):
+            self.collection.upsert(
+                documents=documents[start:start + UPSERT_BATCH_SIZE],
+                metadatas=metadatas[start:start + UPSERT_BATCH_SIZE],
+                ids=ids[start:start + UPSERT_BATCH_SIZE]
+            )
+
+        # Drop chunks of fields that no longer exist in the sample
+        try:
+            existing = self.collection.get(
+                where={"$and": [{"db_name": db_name}, {"collection_name": collection_name}]},
+                include=[]
+            )
+            stale_ids = set(existing['ids']) - set(ids)
+            if stale_ids:
+                self.collection.delete(ids=list(stale_ids))
+                logger.debug(f"Removed {len(stale_ids)} stale field chunks for {doc_id}")
+        except Exception as e:
+            logger.warning(f"Failed to prune stale field chunks for {doc_id}: {e}")
+
+        # Keep the lexical (BM25) index in step with the vector index
+        get_lexical_index(db_name).add(collection_name, fields, metadata)
 
     def store_chat_interaction(self, user_query, ai_response, session_id):
         """
@@ -88,27 +131,182 @@ class ChromaService:
             ids=[interaction_id]
         )
 
-    def retrieve_context(self, query, db_name=None, n_results=15):
+    def retrieve_context(self, query, db_name=None, n_results=5, n_candidates=40):
         """
         Retrieves relevant schema/collection info based on user query.
+        Two stages: field chunk hits (aggregated per collection) merged with a BM25 prefilter
+        over collection/field names, then a local reranker keeps only the best `n_results`.
+        Each returned document lists only the field paths relevant to the query.
         """
         logger.debug(f"Retrieving context for query: {query}, db: {db_name}")
         
+        documents, metadatas, distances = self._query_schema_chunks(query, db_name, n_candidates)
+
+        # Aggregate chunk hits to collections: best chunk distance, matched field paths in rank order
+        candidates = {}
+        for doc, meta, distance in zip(documents, metadatas, distances):
+            col_name = meta['collection_name']
+            candidate = candidates.setdefault(col_name, {
+                "metadata": {"db_name": meta.get('db_name'), "collection_name": col_name},
+                "distance": distance, "bm25": 0.0, "fields": [], "raw": None,
+            })
+            if distance is not None and (candidate["distance"] is None or distance < candidate["distance"]):
+                candidate["distance"] = distance
+            if meta.get('field_path'):
+                candidate["fields"].append((meta['field_path'], meta.get('field_type', ''), meta.get('example', '')))
+            elif 'field_path' not in meta:
+                # Legacy whole-collection document stored before per-field chunking
+                candidate["raw"] = doc
+
+        lexical_index = self._get_lexical_index(db_name) if db_name else None
+        if lexical_index:
+            for col_name, score in lexical_index.search(query, n_results=n_candidates):
+                candidate = candidates.setdefault(col_name, {
+                    "metadata": lexical_index.get_metadata(col_name),
+                    "distance": None, "bm25": 0.0, "fields": [], "raw": None,
+                })
+                candidate["bm25"] = score
+                candidate["fields"].extend(lexical_index.matching_fields(col_name, query))
+
+        for col_name, candidate in candidates.items():
+            if not candidate["fields"] and lexical_index:
+                # Matched on the collection itself: describe it by its top-level fields
+                candidate["fields"] = [f for f in lexical_index.fields.get(col_name, []) if '.' not in f[0]]
+            candidate["document"] = self._format_fields(candidate)
+
+        return rerank(query, candidates, top_k=n_results)
+
+    def _query_schema_chunks(self, query, db_name, n_results):
+        """
+        Nearest schema chunks as (documents, metadatas, distances).
+        Served from the local vector replica of the database; ChromaDB is only queried
+        on a replica miss, error or outdated generation (the database was re-indexed, possibly
+        by another process), which also triggers (re)loading the replica in the background.
+        """
+        generation = None
+        try:
+            replica = get_replica_store().get(db_name) if db_name else None
+            generation = get_index_status_store().latest_generation(db_name) if db_name else None
+            if replica is not None and len(replica) and not is_older_generation(replica.generation, generation):
+                query_embedding = self.embedding_fn([query])[0]
+                documents, metadatas, distances = replica.query(query_embedding, n_results)
+                logger.debug(f"Local replica: Found {len(documents)} relevant schema chunks")
+                return documents, metadatas, distances
+        except Exception as e:
+            logger.error(f"Schema replica query failed for {db_name}, falling back to ChromaDB: {e}")
+
+        if db_name:
+            self._refresh_replica_async(db_name, generation)
+
         where_filter = {"db_name": db_name} if db_name else None
         
         results = self.collection.query(
             query_texts=[query],
             n_results=n_results,
-            where=where_filter
+            where=where_filter,
+            include=["documents", "metadatas", "distances"]
         )
         found_count = len(results['documents'][0]) if results['documents'] else 0
-        logger.debug(f"ChromaDB: Found {found_count} relevant schema documents")
+        logger.debug(f"ChromaDB: Found {found_count} relevant schema chunks")
         
         # Flatten results
         documents = results['documents'][0] if results['documents'] else []
         metadatas = results['metadatas'][0] if results['metadatas'] else []
-        
-        return list(zip(documents, metadatas))
+        distances = results['distances'][0] if results.get('distances') else [None] * len(documents)
+        return documents, metadatas, distances
+
+    def refresh_replica(self, db_name, generation=None):
+        """
+        Reloads the local vector replica of a database's schema chunks from ChromaDB.
+        Called by the indexer after upserting a database, with the generation it is completing.
+        """
+        stored = self.collection.get(where={"db_name": db_name}, include=["embeddings", "documents", "metadatas"])
+        if not len(stored['ids']):
+            return None
+        return get_replica_store().put(db_name, stored['ids'], stored['embeddings'], stored['documents'],
+                                       stored['metadatas'], generation=generation)
+
+    def _refresh_replica_async(self, db_name, generation=None):
+        """
+        Loads the replica in the background, tagged with the generation known when the load started,
+        so it cannot replace a replica the indexer stores in the meantime.
+        """
+        with _pending_replica_lock:
+            if db_name in _pending_replicas:
+                return
+            _pending_replicas.add(db_name)
+
+        def load():
+            try:
+                self.refresh_replica(db_name, generation)
+            except Exception as e:
+                logger.error(f"Failed to load schema vector replica for {db_name}: {e}")
+            finally:
+                with _pending_replica_lock:
+                    _pending_replicas.discard(db_name)
+
+        threading.Thread(target=load, name=f"replica-{db_name}", daemon=True).start()
+
+    @staticmethod
+    def _format_fields(candidate):
+        seen = set()
+        lines = []
+        for path, type_name, example in candidate["fields"]:
+            if path not in seen:
+                seen.add(path)
+                lines.append(format_field(path, type_name, example))
+        if not lines and candidate["raw"]:
+            return candidate["raw"]
+        return "\n".join(lines[:MAX_FIELDS_PER_COLLECTION])
+
+    def _get_lexical_index(self, db_name):
+        """
+        Returns the BM25 index for a database, rebuilding it from ChromaDB when this process
+        has none or it predates the latest index generation (e.g. re-indexed by `refresh_schemas`).
+        """
+        index = get_lexical_index(db_name, create=False)
+        try:
+            generation = get_index_status_store().latest_generation(db_name)
+        except Exception as e:
+            logger.error(f"Failed to read index generation for {db_name}: {e}")
+            generation = None
+        if index is None or len(index) == 0 or is_older_generation(index.generation, generation):
+            index = self.rebuild_lexical_index(db_name, generation) or index
+        return index
+
+    def rebuild_lexical_index(self, db_name, generation=None):
+        """
+        Builds a fresh BM25 index from the schema chunks stored in ChromaDB, so collections
+        dropped since the last build disappear, and installs it. Returns None on failure.
+        """
+        try:
+            stored = self.collection.get(where={"db_name": db_name}, include=["metadatas"])
+        except Exception as e:
+            logger.error(f"Failed to rebuild lexical schema index for {db_name}: {e}")
+            return None
+
+        index = LexicalSchemaIndex(generation)
+        fields_by_collection = {}
+        for meta in stored['metadatas']:
+            fields = fields_by_collection.setdefault(meta['collection_name'], [])
+            if meta.get('field_path'):
+                fields.append((meta['field_path'], meta.get('field_type', ''), meta.get('example', '')))
+        for col_name, fields in fields_by_collection.items():
+            index.add(col_name, fields, {"db_name": db_name, "collection_name": col_name})
+        logger.info(f"Rebuilt lexical schema index for {db_name}: {len(index)} collections (generation {generation})")
+        return set_lexical_index(db_name, index)
+
+    def prune_collections(self, db_name, collection_names):
+        """
+        Deletes the schema chunks of collections that no longer exist in the database.
+        """
+        where = {"db_name": db_name}
+        if collection_names:
+            where = {"$and": [where, {"collection_name": {"$nin": list(collection_names)}}]}
+        stale = self.collection.get(where=where, include=[])
+        if stale['ids']:
+            self.collection.delete(ids=stale['ids'])
+            logger.info(f"Removed {len(stale['ids'])} schema chunks of dropped collections in {db_name}")
 
     def retrieve_chat_history(self, query, session_id, n_results=5):
         """
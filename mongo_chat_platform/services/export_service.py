@@ -0,0 +1,81 @@
+import csv
+import json
+from bson import json_util
+from bson.json_util import RELAXED_JSON_OPTIONS
+from mongo_chat_platform.logger import logger
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+class _LineBuffer:
+    """
+    File-like object for csv.writer that hands back each written row instead of storing it.
+    """
+    def write(self, value):
+        return value
+
+
+def _chunked(lines, chunk_size):
+    """
+    Joins lines into chunks of `chunk_size` so the response is not written one document at a time.
+    """
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= chunk_size:
+            yield "".join(chunk)
+            chunk = []
+    if chunk:
+        yield "".join(chunk)
+
+
+def iter_ndjson(documents, chunk_size=500):
+    """
+    One relaxed extended JSON document per line.
+    """
+    lines = (json_util.dumps(doc, json_options=RELAXED_JSON_OPTIONS) + "\n" for doc in documents)
+    return _chunked(lines, chunk_size)
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str)
+    return str(value)
+
+
+def iter_csv(documents, columns=None, chunk_size=500):
+    """
+    CSV with a header row. Columns come from `columns` (e.g. the projection) or the first document;
+    nested values are written as JSON.
+    """
+    writer = csv.writer(_LineBuffer())
+    documents = iter(documents)
+
+    def rows():
+        first = next(documents, None)
+        if first is None:
+            if columns:
+                yield writer.writerow(columns)
+            return
+        header = list(columns) if columns else list(first.keys())
+        yield writer.writerow(header)
+        yield writer.writerow([_csv_value(first.get(c)) for c in header])
+        for doc in documents:
+            yield writer.writerow([_csv_value(doc.get(c)) for c in header])
+
+    return _chunked(rows(), chunk_size)
+
+
+def stream_export(documents, export_format, columns=None, chunk_size=500):
+    """
+    Returns a generator of response chunks for the given format.
+    """
+    logger.info(f"Streaming {export_format} export")
+    if export_format == "csv":
+        return iter_csv(documents, columns, chunk_size)
+    return iter_ndjson(documents, chunk_size)
@@ -0,0 +1,314 @@
+import datetime
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from mongo_chat_platform.services.mongo_service import MongoService, get_client
+from mongo_chat_platform.logger import logger
+
+
+def cluster_key(uri):
+    """
+    Returns the host part of a MongoDB URI (no scheme, credentials or options).
+    Used to group databases living on the same cluster.
+    """
+    host_part = uri.split('://', 1)[-1].split('@')[-1]
+    return host_part.split('/')[0].split('?')[0]
+
+
+class IndexStatusStore:
+    """
+    Keeps schema indexing status per database.
+    Status is held in memory and mirrored to the app's own MongoDB (MONGO_LOGS_URI)
+    so that a separate `refresh_schemas` process and the web server see the same state.
+
+    A completed run records its `generation` (finish time). Derived in-memory state such as
+    the vector replica is tagged with the generation it was built from and reloaded when it moves on.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._statuses = {}
+        self._generations = {}
+        self.collection = None
+
+        uri = os.getenv("MONGO_LOGS_URI")
+        if uri:
+            try:
+                self.collection = get_client(uri).get_default_database()['schema_index_status']
+            except Exception as e:
+                logger.error(f"Index status persistence disabled: {e}")
+
+    def get(self, key):
+        with self._lock:
+            status = self._statuses.get(key)
+            if status:
+                return dict(status)
+
+        if self.collection is not None:
+            try:
+                doc = self.collection.find_one({"_id": key})
+                if doc:
+                    doc.pop('_id', None)
+                    return doc
+            except Exception as e:
+                logger.error(f"Failed to read index status for {key}: {e}")
+        return None
+
+    def update(self, key, persist=False, **fields):
+        with self._lock:
+            status = self._statuses.setdefault(key, {})
+            status.update(fields)
+            snapshot = dict(status)
+
+        # Only state transitions are persisted, per-collection progress stays in memory
+        if persist and self.collection is not None:
+            try:
+                self.collection.update_one({"_id": key}, {"$set": snapshot}, upsert=True)
+            except Exception as e:
+                logger.error(f"Failed to persist index status for {key}: {e}")
+        return snapshot
+
+    def latest_generation(self, db_name):
+        """
+        Generation of the newest completed index of a database, by this or (checked at most every
+        SCHEMA_GENERATION_CHECK_INTERVAL seconds) any other process. None if never indexed.
+        """
+        with self._lock:
+            latest = max((s['generation'] for s in self._statuses.values()
+                          if s.get('db_name') == db_name and s.get('generation')), default=None)
+            cached = self._generations.get(db_name)
+
+        if self.collection is not None:
+            interval = int(os.getenv("SCHEMA_GENERATION_CHECK_INTERVAL", "30"))
+            if cached is None or time.monotonic() - cached[0] >= interval:
+                try:
+                    doc = self.collection.find_one({"db_name": db_name, "generation": {"$ne": None}},
+                                                   {"generation": 1}, sort=[("generation", -1)])
+                    cached = (time.monotonic(), doc['generation'] if doc else None)
+                except Exception as e:
+                    logger.error(f"Failed to read index generation for {db_name}: {e}")
+                    cached = (time.monotonic(), cached[1] if cached else None)
+                with self._lock:
+                    self._generations[db_name] = cached
+            if cached[1] is not None and (latest is None or cached[1] > latest):
+                latest = cached[1]
+        return latest
+
+
+_index_status_store = None
+_index_status_store_lock = threading.Lock()
+
+
+def get_index_status_store():
+    global _index_status_store
+    with _index_status_store_lock:
+        if _index_status_store is None:
+            _index_status_store = IndexStatusStore()
+        return _index_status_store
+
+
+class SchemaIndexer:
+    """
+    Indexes database schemas into ChromaDB off the request path.
+
+    - Jobs run on a thread pool, with at most `max_per_cluster` concurrent jobs per cluster.
+      Jobs over that limit wait in a per-cluster queue rather than in a pool thread, so a busy
+      cluster never holds up jobs for other clusters.
+    - Databases registered via `ensure_indexed` are re-indexed every `refresh_interval`
+      seconds by an in-process scheduler thread (disabled when the interval is 0).
+    """
+    def __init__(self, max_workers=None, max_per_cluster=None, refresh_interval=None):
+        self.max_workers = max_workers or int(os.getenv("SCHEMA_INDEX_WORKERS", "4"))
+        self.max_per_cluster = max_per_cluster or int(os.getenv("SCHEMA_INDEX_MAX_PER_CLUSTER", "2"))
+        if refresh_interval is None:
+            refresh_interval = int(os.getenv("SCHEMA_REFRESH_INTERVAL", "0"))
+        self.refresh_interval = refresh_interval
+
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="schema-indexer")
+        self.status_store = get_index_status_store()
+
+        self._lock = threading.Lock()
+        self._registered = {}
+        self._in_flight = {}
+        self._cluster_active = {}
+        self._cluster_pending = {}
+        self._scheduler_thread = None
+        logger.info(f"SchemaIndexer initialized (workers: {self.max_workers}, per cluster: {self.max_per_cluster}, "
+                    f"refresh interval: {self.refresh_interval}s)")
+
+    @staticmethod
+    def status_key(uri, db_name):
+        return f"{cluster_key(uri)}/{db_name or '(default)'}"
+
+    def get_status(self, uri, db_name):
+        return self.status_store.get(self.status_key(uri, db_name))
+
+    def ensure_indexed(self, uri, db_name):
+        """
+        Registers the database for background refreshes and schedules an indexing job
+        unless one is running or a fresh index already exists. Never blocks on indexing.
+        """
+        key = self.status_key(uri, db_name)
+        with self._lock:
+            self._registered[key] = (uri, db_name)
+
+        status = self.status_store.get(key)
+        with self._lock:
+            future = self._in_flight.get(key)
+            running_here = future is not None and not future.done()
+        if not running_here and (not status or status.get('state') == 'failed' or self._is_stale(status)):
+            self.submit(uri, db_name)
+            status = self.status_store.get(key)
+
+        self._start_scheduler()
+        return status
+
+    def submit(self, uri, db_name, on_progress=None):
+        """
+        Schedules an indexing job. Returns the existing future if the database is already queued.
+        """
+        key = self.status_key(uri, db_name)
+        cluster = cluster_key(uri)
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future and not future.done():
+                return future
+
+            self.status_store.update(key, persist=True, state='pending', indexed=0, total=None, error=None,
+                                     queued_at=datetime.datetime.utcnow())
+            future = Future()
+            self._in_flight[key] = future
+            self._cluster_pending.setdefault(cluster, deque()).append((future, uri, db_name, on_progress))
+            jobs = self._take_jobs(cluster)
+        self._start_jobs(cluster, jobs)
+        return future
+
+    def _take_jobs(self, cluster):
+        """
+        Pops the queued jobs of a cluster that fit under `max_per_cluster`. Caller holds the lock.
+        """
+        pending = self._cluster_pending.get(cluster)
+        jobs = []
+        while pending and self._cluster_active.get(cluster, 0) < self.max_per_cluster:
+            jobs.append(pending.popleft())
+            self._cluster_active[cluster] = self._cluster_active.get(cluster, 0) + 1
+        return jobs
+
+    def _start_jobs(self, cluster, jobs):
+        for future, uri, db_name, on_progress in jobs:
+            job = self.executor.submit(self.index_database, uri, db_name, on_progress)
+            job.add_done_callback(partial(self._job_done, cluster, future))
+
+    def _job_done(self, cluster, future, job):
+        # Frees the cluster slot and hands it to the next queued job of the same cluster
+        with self._lock:
+            self._cluster_active[cluster] -= 1
+            jobs = self._take_jobs(cluster)
+        self._start_jobs(cluster, jobs)
+
+        if job.exception() is not None:
+            future.set_exception(job.exception())
+        else:
+            future.set_result(job.result())
+
+    def index_database(self, uri, db_name, on_progress=None):
+        """
+        Extracts the schema of every collection and upserts it into ChromaDB.
+        """
+        # Imported here so that the scheduler does not load the embedding model until a job runs
+        from mongo_chat_platform.services.chroma_service import ChromaService
+
+        key = self.status_key(uri, db_name)
+        started = datetime.datetime.utcnow()
+        self.status_store.update(key, persist=True, state='running', started_at=started)
+        logger.info(f"Schema indexing started for {key}")
+        try:
+            mongo_service = MongoService(uri, db_name)
+            chroma_service = ChromaService()
+            resolved_db = mongo_service.db.name
+            self.status_store.update(key, db_name=resolved_db)
+
+            names = mongo_service.get_collection_names(refresh=True)
+            self.status_store.update(key, total=len(names))
+            for i, col_name in enumerate(names, start=1):
+                chroma_service.store_schema(resolved_db, col_name, mongo_service.get_sample_document(col_name))
+                status = self.status_store.update(key, indexed=i)
+                if on_progress:
+                    on_progress(key, status)
+            chroma_service.prune_collections(resolved_db, names)
+
+            # Millisecond precision, as stored by MongoDB, so generations compare equal across processes
+            finished_at = datetime.datetime.utcnow()
+            generation = finished_at.replace(microsecond=finished_at.microsecond // 1000 * 1000)
+            try:
+                chroma_service.refresh_replica(resolved_db, generation)
+            except Exception as e:
+                # The index itself is complete; lookups fall back to ChromaDB until the replica loads
+                logger.error(f"Schema replica refresh failed for {key}: {e}")
+            # Rebuilt rather than patched, so dropped collections leave the BM25 index too
+            chroma_service.rebuild_lexical_index(resolved_db, generation)
+
+            status = self.status_store.update(key, persist=True, state='done', finished_at=finished_at,
+                                              generation=generation)
+            logger.info(f"Schema indexing completed for {key}: {len(names)} collections")
+        except Exception as e:
+            logger.error(f"Schema indexing failed for {key}: {e}")
+            status = self.status_store.update(key, persist=True, state='failed', error=str(e),
+                                              finished_at=datetime.datetime.utcnow())
+        if on_progress:
+            on_progress(key, status)
+        return status
+
+    def refresh_registered(self):
+        with self._lock:
+            targets = list(self._registered.values())
+        logger.info(f"Refreshing {len(targets)} registered schema indexes")
+        return [self.submit(uri, db_name) for uri, db_name in targets]
+
+    def _is_stale(self, status):
+        if status.get('state') in ('pending', 'running'):
+            # A job left behind by another (possibly dead) process is retried after a timeout
+            since = status.get('started_at') or status.get('queued_at')
+            timeout = int(os.getenv("SCHEMA_INDEX_TIMEOUT", "600"))
+            return not since or (datetime.datetime.utcnow() - since).total_seconds() > timeout
+        if status.get('state') != 'done' or not self.refresh_interval:
+            return False
+        finished_at = status.get('finished_at')
+        if not finished_at:
+            return True
+        return (datetime.datetime.utcnow() - finished_at).total_seconds() > self.refresh_interval
+
+    def _start_scheduler(self):
+        if not self.refresh_interval:
+            return
+        with self._lock:
+            if self._scheduler_thread and self._scheduler_thread.is_alive():
+                return
+            self._scheduler_thread = threading.Thread(target=self._scheduler_loop, name="schema-refresh", daemon=True)
+            self._scheduler_thread.start()
+        logger.info(f"Schema refresh scheduler started (every {self.refresh_interval}s)")
+
+    def _scheduler_loop(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh_registered()
+            except Exception as e:
+                logger.error(f"Scheduled schema refresh failed: {e}")
+
+
+_schema_indexer = None
+_schema_indexer_lock = threading.Lock()
+
+
+def get_schema_indexer():
+    """
+    Returns the process-wide SchemaIndexer.
+    """
+    global _schema_indexer
+    with _schema_indexer_lock:
+        if _schema_indexer is None:
+            _schema_indexer = SchemaIndexer()
+        return _schema_indexer
@@ -1,22 +1,313 @@
+import hashlib
+import json
 import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass
+import groq
 from groq import Groq
 from django.conf import settings
 from mongo_chat_platform.logger import logger
 
+TRANSIENT_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+# Tool call markers of the chat prompt; the tool stage stops generating at the end marker
+TOOL_START_MARKER = "<<<QUERY>>>"
+TOOL_END_MARKER = "<<<END_QUERY>>>"
+
+
+class LLMScheduler:
+    """
+    Process-wide pacing for Groq calls:
+    - keeps requests and tokens per minute under the configured limits (callers queue until there is room),
+    - retries transient failures (429, 5xx, timeouts, connection errors) with jittered exponential backoff,
+    - coalesces identical in-flight requests into a single API call.
+    """
+    window_seconds = 60
+
+    def __init__(self, rpm_limit=None, tpm_limit=None, max_retries=None, backoff_base=None, backoff_cap=None):
+        self.rpm_limit = rpm_limit or int(os.getenv("GROQ_RPM_LIMIT", "30"))
+        self.tpm_limit = tpm_limit or int(os.getenv("GROQ_TPM_LIMIT", "6000"))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("GROQ_MAX_RETRIES", "3"))
+        self.backoff_base = backoff_base or float(os.getenv("GROQ_BACKOFF_BASE", "1.0"))
+        self.backoff_cap = backoff_cap or float(os.getenv("GROQ_BACKOFF_CAP", "30"))
+
+        self._cond = threading.Condition()
+        self._window = deque()  # [started_at, tokens] per request in the last minute
+        self._in_flight = {}    # request key -> Future
+        self._metrics = {
+            "requests": 0, "retries": 0, "coalesced": 0, "failures": 0,
+            "queue_depth": 0, "max_queue_depth": 0,
+            "wait_time_total": 0.0, "wait_time_max": 0.0, "last_wait_time": 0.0,
+        }
+
+    def run(self, key, estimated_tokens, call):
+        """
+        Runs `call()` under the rate limits and returns its result.
+        Concurrent calls with the same `key` share one execution.
+        """
+        with self._cond:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._in_flight[key] = future
+            else:
+                self._metrics["coalesced"] += 1
+
+        if not leader:
+            logger.debug("Coalescing identical in-flight LLM request")
+            return future.result()
+
+        try:
+            result = self._run_with_retries(estimated_tokens, call)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._cond:
+                self._in_flight.pop(key, None)
+
+    def _run_with_retries(self, estimated_tokens, call):
+        attempt = 0
+        while True:
+            entry = self._acquire(estimated_tokens)
+            try:
+                result = call()
+                usage = getattr(result, "usage", None)
+                if usage is not None and getattr(usage, "total_tokens", None):
+                    with self._cond:
+                        entry[1] = usage.total_tokens
+                return result
+            except Exception as e:
+                if attempt >= self.max_retries or not self._is_transient(e):
+                    with self._cond:
+                        self._metrics["failures"] += 1
+                    raise
+                delay = self._backoff(attempt, e)
+                with self._cond:
+                    self._metrics["retries"] += 1
+                logger.warning(f"Transient LLM error ({e.__class__.__name__}), retry {attempt + 1}/{self.max_retries} "
+                               f"in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+
+    def _acquire(self, tokens):
+        started = time.monotonic()
+        with self._cond:
+            self._metrics["queue_depth"] += 1
+            self._metrics["max_queue_depth"] = max(self._metrics["max_queue_depth"], self._metrics["queue_depth"])
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._prune(now)
+                    wait = self._wait_time(now, tokens)
+                    if wait <= 0:
+                        break
+                    logger.debug(f"LLM rate limit reached, queueing for {wait:.1f}s")
+                    self._cond.wait(timeout=wait)
+                entry = [now, tokens]
+                self._window.append(entry)
+            finally:
+                self._metrics["queue_depth"] -= 1
+
+            waited = time.monotonic() - started
+            self._metrics["requests"] += 1
+            self._metrics["wait_time_total"] += waited
+            self._metrics["wait_time_max"] = max(self._metrics["wait_time_max"], waited)
+            self._metrics["last_wait_time"] = waited
+        return entry
+
+    def _prune(self, now):
+        while self._window and now - self._window[0][0] >= self.window_seconds:
+            self._window.popleft()
+
+    def _wait_time(self, now, tokens):
+        waits = []
+        if len(self._window) >= self.rpm_limit:
+            waits.append(self._window[0][0] + self.window_seconds - now)
+
+        used = sum(t for _, t in self._window)
+        if self._window and used + tokens > self.tpm_limit:
+            # Wait until enough of the oldest requests leave the window
+            freed = 0
+            for started_at, t in self._window:
+                freed += t
+                if used - freed + tokens <= self.tpm_limit:
+                    break
+            waits.append(started_at + self.window_seconds - now)
+        return max(waits, default=0)
+
+    @staticmethod
+    def _is_transient(error):
+        if isinstance(error, (groq.RateLimitError, groq.APIConnectionError, groq.InternalServerError)):
+            return True
+        return getattr(error, "status_code", None) in TRANSIENT_STATUS_CODES
+
+    def _backoff(self, attempt, error):
+        # Full jitter, but never sooner than the server's Retry-After
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        try:
+            return max(delay, float(retry_after)) if retry_after else delay
+        except ValueError:
+            return delay
+
+    def get_metrics(self):
+        with self._cond:
+            self._prune(time.monotonic())
+            metrics = dict(self._metrics)
+            metrics["requests_last_minute"] = len(self._window)
+            metrics["tokens_last_minute"] = sum(t for _, t in self._window)
+            metrics["in_flight"] = len(self._in_flight)
+        metrics["avg_wait_time"] = metrics["wait_time_total"] / metrics["requests"] if metrics["requests"] else 0.0
+        metrics["rpm_limit"] = self.rpm_limit
+        metrics["tpm_limit"] = self.tpm_limit
+        return metrics
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_llm_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = LLMScheduler()
+        return _scheduler
+
+
+@dataclass(frozen=True)
+class ModelProfile:
+    """
+    Model settings for one stage of the chat pipeline.
+    """
+    stage: str
+    model: str
+    max_tokens: int
+    temperature: float
+    timeout: float
+    fallback_model: str = None
+    latency_slo: float = None
+    stop: tuple = ()
+
+
+def load_model_profiles(default_model):
+    """
+    Builds stage profiles from GROQ_<STAGE>_* environment variables.
+    - tool: first chat pass and generate_mongo_query, which only emit a short JSON block (small, fast model,
+            stopped at the end of the tool call); its no-tool drafts are the answer unless truncated
+    - answer: final answers, falling back to the tool model
+    - summary: background conversation memory folding
+    """
+    def profile(stage, model, max_tokens, timeout, fallback_model, latency_slo, stop=()):
+        prefix = f"GROQ_{stage.upper()}_"
+        slo = os.getenv(prefix + "LATENCY_SLO", latency_slo)
+        return ModelProfile(
+            stage=stage,
+            model=os.getenv(prefix + "MODEL", model),
+            max_tokens=int(os.getenv(prefix + "MAX_TOKENS", max_tokens)),
+            temperature=float(os.getenv(prefix + "TEMPERATURE", "0.1")),
+            timeout=float(os.getenv(prefix + "TIMEOUT", timeout)),
+            fallback_model=os.getenv(prefix + "FALLBACK_MODEL", fallback_model) or None,
+            latency_slo=float(slo) if slo else None,
+            stop=stop,
+        )
+
+    tool_model = os.getenv("GROQ_TOOL_MODEL", "llama-3.1-8b-instant")
+    return {
+        "tool": profile("tool", tool_model, "1024", "15", default_model, "3", stop=(TOOL_END_MARKER,)),
+        "answer": profile("answer", default_model, "1024", "60", tool_model, "15"),
+        "summary": profile("summary", tool_model, "512", "30", default_model, None),
+    }
+
+
+class LatencyTracker:
+    """
+    Tracks per-model latency (EWMA) and marks a model degraded for a cooldown period
+    when it breaches its latency SLO or keeps failing transiently, so that requests go to the fallback model.
+    """
+    alpha = 0.3
+
+    def __init__(self, cooldown=None):
+        self.cooldown = cooldown or float(os.getenv("GROQ_SLO_COOLDOWN", "60"))
+        self._lock = threading.Lock()
+        self._latency = {}
+        self._degraded_until = {}
+
+    def record(self, model, seconds, latency_slo=None):
+        with self._lock:
+            previous = self._latency.get(model)
+            latency = seconds if previous is None else self.alpha * seconds + (1 - self.alpha) * previous
+            self._latency[model] = latency
+        if latency_slo and latency > latency_slo:
+            logger.warning(f"Model {model} breached latency SLO ({latency:.1f}s > {latency_slo:.1f}s)")
+            self.mark_degraded(model)
+
+    def mark_degraded(self, model):
+        with self._lock:
+            self._degraded_until[model] = time.monotonic() + self.cooldown
+            # Start fresh once the cooldown ends
+            self._latency.pop(model, None)
+
+    def is_degraded(self, model):
+        with self._lock:
+            return self._degraded_until.get(model, 0) > time.monotonic()
+
+    def get_metrics(self):
+        with self._lock:
+            now = time.monotonic()
+            return {
+                "latency_ewma": dict(self._latency),
+                "degraded": [m for m, until in self._degraded_until.items() if until > now],
+            }
+
+
+_latency_tracker = LatencyTracker()
+
+
+def get_llm_metrics():
+    """
+    Scheduler metrics (queue depth, wait times, retries, coalesced requests, usage)
+    plus per-model latency and degraded models.
+    """
+    return {**get_llm_scheduler().get_metrics(), **_latency_tracker.get_metrics()}
+
+
 class LLMService:
     def __init__(self):
         self.api_key = os.getenv("GROQ_API_KEY")
         if not self.api_key:
              # Fallback or error logging
              logger.warning("GROQ_API_KEY not found in environment variables.")
-        self.client = Groq(api_key=self.api_key)
+        # Retries are owned by the shared scheduler, not the SDK
+        self.client = Groq(api_key=self.api_key, max_retries=0)
         self.model = os.getenv("GROQ_MODEL", "mixtral-8x7b-32768")
-        logger.info(f"LLMService initialized with model: {self.model}")
+        self.profiles = load_model_profiles(self.model)
+        self.scheduler = get_llm_scheduler()
+        self.latency_tracker = _latency_tracker
+        logger.info(f"LLMService initialized with model: {self.model} "
+                    f"(tool stage: {self.profiles['tool'].model}, answer stage: {self.profiles['answer'].model})")
 
-    def generate_response(self, system_prompt, user_query, conversation_history=None):
+    def generate_response(self, system_prompt, user_query, conversation_history=None, stage="answer"):
         """
-        Generates a response from the LLM.
+        Generates a response from the LLM using the model profile of `stage` ("tool" or "answer").
         """
+        return self.generate_draft(system_prompt, user_query, conversation_history, stage)[0]
+
+    def generate_draft(self, system_prompt, user_query, conversation_history=None, stage="tool"):
+        """
+        Like generate_response, but returns (response, truncated), where `truncated` tells
+        whether the completion was cut off at the profile's max_tokens.
+        """
+        profile = self.profiles.get(stage, self.profiles["answer"])
         messages = [{"role": "system", "content": system_prompt}]
         
         if conversation_history:
@@ -26,27 +317,76 @@ class LLMService:
         messages.append({"role": "user", "content": user_query})
 
         try:
-            logger.info(f"Generating LLM response. Model: {self.model}")
+            logger.info(f"Generating LLM response. Stage: {profile.stage}")
             logger.debug(f"Context Message Count: {len(messages)}")
             if len(messages) > 0:
                  logger.debug(f"System Prompt Preview: {messages[0]['content'][:100]}...")
 
-            completion = self.client.chat.completions.create(
-                model=self.model,
+            completion = self._complete(profile, messages)
+            choice = completion.choices[0]
+            response = choice.message.content or ""
+            # The stop sequence is not part of the completion: close a tool call that ended on it
+            if TOOL_END_MARKER in profile.stop and choice.finish_reason == "stop" \
+                    and TOOL_START_MARKER in response and TOOL_END_MARKER not in response:
+                response += TOOL_END_MARKER
+            truncated = choice.finish_reason == "length"
+            logger.info("LLM Response generated successfully" + (" (truncated)" if truncated else ""))
+            logger.debug(f"Response Preview: {response[:100]}...")
+            return response, truncated
+        except Exception as e:
+            logger.exception(f"CRITICAL: Error communicating with Groq API: {str(e)}")
+            return f"Error generating response: {str(e)}", False
+
+    def _complete(self, profile, messages):
+        """
+        Calls the profile's model, or its fallback when the model is degraded (SLO breach or transient failure).
+        """
+        models = [profile.model]
+        if profile.fallback_model and profile.fallback_model != profile.model:
+            if self.latency_tracker.is_degraded(profile.model):
+                logger.info(f"Model {profile.model} is degraded, routing to {profile.fallback_model}")
+                models = [profile.fallback_model]
+            else:
+                models.append(profile.fallback_model)
+
+        last_error = None
+        for model in models:
+            request = dict(
+                model=model,
                 messages=messages,
-                temperature=0.1, # Low temperature for factual data querying
-                max_tokens=1024,
+                temperature=profile.temperature, # Low temperature for factual data querying
+                max_tokens=profile.max_tokens,
                 top_p=1,
                 stream=False,
-                stop=None,
+                stop=list(profile.stop) or None,
             )
-            response = completion.choices[0].message.content
-            logger.info("LLM Response generated successfully")
-            logger.debug(f"Response Preview: {response[:100]}...")
-            return response
-        except Exception as e:
-            logger.exception(f"CRITICAL: Error communicating with Groq API: {str(e)}")
-            return f"Error generating response: {str(e)}"
+            # Rough prompt size (~4 chars per token) plus the completion budget
+            estimated_tokens = sum(len(m['content']) for m in messages) // 4 + request['max_tokens']
+            key = hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+            latency = []
+
+            def call(request=request, latency=latency):
+                started = time.monotonic()
+                completion = self.client.chat.completions.create(**request, timeout=profile.timeout)
+                latency.append(time.monotonic() - started)
+                return completion
+
+            try:
+                logger.debug(f"Calling model {model} (max_tokens: {profile.max_tokens}, timeout: {profile.timeout}s)")
+                completion = self.scheduler.run(key, estimated_tokens, call)
+            except Exception as e:
+                logger.warning(f"Model {model} failed: {e}")
+                # Only timeouts and transient errors say something about the model; a rejected
+                # request (invalid, context too long) would fail the same way for everyone
+                if self.scheduler._is_transient(e):
+                    self.latency_tracker.mark_degraded(model)
+                last_error = e
+                continue
+
+            if latency:
+                self.latency_tracker.record(model, latency[0], profile.latency_slo)
+            return completion
+        raise last_error
 
     def generate_mongo_query(self, schema_info, user_query, history=None):
         """
@@ -64,4 +404,25 @@ class LLMService:
         3. If a simple find is needed, return {{ ... }}.
         4. Use double quotes for keys.
         """
-        return self.generate_response(system_prompt, user_query, history)
+        return self.generate_response(system_prompt, user_query, history, stage="tool")
+
+    def summarize_conversation(self, previous_summary, turns):
+        """
+        Folds chat turns into a running summary. Raises on API errors (runs in the background,
+        so a failed fold is simply retried with the next turn).
+        """
+        transcript = "\n".join(f"{m['role'].capitalize()}: {m['content'][:1000]}" for m in turns)
+        messages = [
+            {"role": "system", "content": (
+                "You maintain a running summary of a conversation between a user and a MongoDB assistant. "
+                "Merge the new turns into the existing summary. Keep collection names, field names, filters, "
+                "numbers and conclusions the user may refer back to. Be concise: at most 200 words. "
+                "Return only the updated summary."
+            )},
+            {"role": "user", "content": f"Existing summary:\n{previous_summary or '(none)'}\n\nNew turns:\n{transcript}"},
+        ]
+        completion = self._complete(self.profiles["summary"], messages)
+        return completion.choices[0].message.content.strip()
+
+    def get_metrics(self):
+        return get_llm_metrics()
@@ -1,10 +1,32 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 import datetime
 from pymongo import MongoClient
 import datetime
 import os
 from mongo_chat_platform.logger import logger
 
+# Rollup buckets are hourly; dashboards read these instead of scanning chat_logs
+ROLLUP_COLLECTION = "chat_log_rollups"
+_rollup_indexes_ready = False
+
+
+def _hour(timestamp):
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def to_naive_utc(value):
+    """
+    Converts a datetime to the naive UTC form rollup buckets are stored in.
+    Aware values are converted to UTC first; naive values are taken as UTC already.
+    """
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc)
+    return value.replace(tzinfo=None)
+
+
+def _rollup_id(kind, bucket, value):
+    return f"{kind}|{bucket.strftime('%Y-%m-%dT%H')}|{value or ''}"
+
 class ConversationLogger:
     def __init__(self):
         # Use a separate env var for the app's own persistence, or fallback to a local default
@@ -17,20 +39,35 @@ class ConversationLogger:
             self.client = MongoClient(uri)
             self.db = self.client.get_default_database()
             self.collection = self.db['chat_logs']
+            self.rollups = self.db[ROLLUP_COLLECTION]
+            self._ensure_rollup_indexes()
             logger.info("ConversationLogger initialized successfully")
         except Exception as e:
             logger.exception("Failed to initialize ConversationLogger")
             raise e
 
-    def log_interaction(self, ip_address, session_id, user_query, ai_response):
+    def _ensure_rollup_indexes(self):
+        global _rollup_indexes_ready
+        if _rollup_indexes_ready:
+            return
+        try:
+            self.rollups.create_index([("kind", 1), ("bucket", 1)])
+            _rollup_indexes_ready = True
+        except Exception as e:
+            logger.error(f"Failed to create rollup indexes: {e}")
+
+    def log_interaction(self, ip_address, session_id, user_query, ai_response, db_name=None, tool_action=None, tool_error=False):
+        timestamp = datetime.datetime.utcnow()
         log_entry = {
             "ip_address": ip_address,
             "session_id": session_id,
-            "timestamp": datetime.datetime.utcnow(),
+            "db_name": db_name,
+            "timestamp": timestamp,
             "interaction": {
                 "user": user_query,
                 "assistant": ai_response
-            }
+            },
+            "tool": {"action": tool_action, "error": bool(tool_error)} if tool_action else None
         }
         try:
             result = self.collection.insert_one(log_entry)
@@ -39,6 +76,119 @@ class ConversationLogger:
             logger.critical(f"FATAL: Failed to insert log entry into MongoDB: {e}")
             # We print here as a last resort if the logger itself is failing or if this is running in a context where logger is silenced
             print(f"Error logging conversation: {e}")
+            return
+
+        self._update_rollups(timestamp, ip_address, db_name, tool_action, tool_error)
+
+    def _update_rollups(self, timestamp, ip_address, db_name, tool_action, tool_error):
+        """
+        Increments the hourly per-database and per-IP buckets for one interaction.
+        """
+        bucket = _hour(timestamp)
+        db_counts = {"questions": 1}
+        if tool_action:
+            db_counts["tool_calls"] = 1
+            db_counts["tool_errors"] = 1 if tool_error else 0
+        try:
+            self.rollups.bulk_write([
+                UpdateOne(
+                    {"_id": _rollup_id("db_hour", bucket, db_name)},
+                    {"$inc": db_counts, "$setOnInsert": {"kind": "db_hour", "bucket": bucket, "db_name": db_name}},
+                    upsert=True
+                ),
+                UpdateOne(
+                    {"_id": _rollup_id("ip_hour", bucket, ip_address)},
+                    {"$inc": {"questions": 1}, "$setOnInsert": {"kind": "ip_hour", "bucket": bucket, "ip_address": ip_address}},
+                    upsert=True
+                ),
+            ], ordered=False)
+        except Exception as e:
+            logger.error(f"Failed to update chat log rollups: {e}")
+
+    def rebuild_rollups(self, since=None):
+        """
+        Recomputes rollup buckets from raw chat_logs with a $merge pipeline (backfill or repair).
+        `since` is rounded down to the hour so that partially covered buckets are not undercounted.
+        """
+        match = {"timestamp": {"$gte": _hour(since)}} if since else {}
+        hour = {"$dateTrunc": {"date": "$timestamp", "unit": "hour"}}
+        hour_str = {"$dateToString": {"date": "$_id.bucket", "format": "%Y-%m-%dT%H"}}
+        merge = {"$merge": {"into": ROLLUP_COLLECTION, "on": "_id", "whenMatched": "replace", "whenNotMatched": "insert"}}
+
+        logger.info(f"Rebuilding chat log rollups since {since or 'the beginning'}")
+        self.collection.aggregate([
+            {"$match": match},
+            {"$group": {
+                "_id": {"bucket": hour, "db_name": "$db_name"},
+                "questions": {"$sum": 1},
+                "tool_calls": {"$sum": {"$cond": [{"$ifNull": ["$tool.action", False]}, 1, 0]}},
+                "tool_errors": {"$sum": {"$cond": [{"$eq": ["$tool.error", True]}, 1, 0]}},
+            }},
+            {"$project": {
+                "_id": {"$concat": ["db_hour|", hour_str, "|", {"$ifNull": ["$_id.db_name", ""]}]},
+                "kind": {"$literal": "db_hour"}, "bucket": "$_id.bucket", "db_name": "$_id.db_name",
+                "questions": 1, "tool_calls": 1, "tool_errors": 1,
+            }},
+            merge,
+        ])
+        self.collection.aggregate([
+            {"$match": match},
+            {"$group": {"_id": {"bucket": hour, "ip_address": "$ip_address"}, "questions": {"$sum": 1}}},
+            {"$project": {
+                "_id": {"$concat": ["ip_hour|", hour_str, "|", {"$ifNull": ["$_id.ip_address", ""]}]},
+                "kind": {"$literal": "ip_hour"}, "bucket": "$_id.bucket", "ip_address": "$_id.ip_address",
+                "questions": 1,
+            }},
+            merge,
+        ])
+
+    def get_questions_per_db_hour(self, start, end, db_name=None):
+        """
+        [{"bucket", "db_name", "questions", "tool_calls", "tool_errors"}] per hour in [start, end).
+        """
+        query = {"kind": "db_hour", "bucket": {"$gte": _hour(start), "$lt": end}}
+        if db_name:
+            query["db_name"] = db_name
+        try:
+            return list(self.rollups.find(query, {"_id": 0, "kind": 0}).sort("bucket", 1))
+        except Exception as e:
+            logger.error(f"Failed to read per-database rollups: {e}")
+            return []
+
+    def get_volume_by_ip(self, start, end, limit=20):
+        """
+        [{"ip_address", "questions"}] for the busiest IPs in [start, end).
+        """
+        try:
+            return list(self.rollups.aggregate([
+                {"$match": {"kind": "ip_hour", "bucket": {"$gte": _hour(start), "$lt": end}}},
+                {"$group": {"_id": "$ip_address", "questions": {"$sum": "$questions"}}},
+                {"$sort": {"questions": -1}},
+                {"$limit": limit},
+                {"$project": {"_id": 0, "ip_address": "$_id", "questions": 1}},
+            ]))
+        except Exception as e:
+            logger.error(f"Failed to read per-IP rollups: {e}")
+            return []
+
+    def get_tool_error_rate(self, start, end, db_name=None):
+        """
+        {"tool_calls", "tool_errors", "error_rate"} over [start, end).
+        """
+        match = {"kind": "db_hour", "bucket": {"$gte": _hour(start), "$lt": end}}
+        if db_name:
+            match["db_name"] = db_name
+        try:
+            totals = next(self.rollups.aggregate([
+                {"$match": match},
+                {"$group": {"_id": None, "tool_calls": {"$sum": "$tool_calls"}, "tool_errors": {"$sum": "$tool_errors"}}},
+            ]), None)
+        except Exception as e:
+            logger.error(f"Failed to read tool error rollups: {e}")
+            totals = None
+        calls = totals["tool_calls"] if totals else 0
+        errors = totals["tool_errors"] if totals else 0
+        return {"tool_calls": calls, "tool_errors": errors, "error_rate": errors / calls if calls else 0.0}
 
     def get_history_by_ip(self, ip_address, limit=50):
         logger.debug(f"Retrieving history for IP: {ip_address}, Limit: {limit}")
@@ -0,0 +1,102 @@
+import datetime
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pymongo.errors import DuplicateKeyError
+from mongo_chat_platform.logger import logger
+from mongo_chat_platform.services.mongo_service import get_client
+
+# Summaries are generated off the request path
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="memory-summarizer")
+_pending_sessions = set()
+_pending_lock = threading.Lock()
+
+
+class ConversationMemory:
+    """
+    Rolling conversation memory per chat session.
+    Older turns are folded into a running summary (stored in the app's MongoDB), so prompts
+    carry the summary plus only the last few raw turns instead of the whole history.
+    """
+    def __init__(self):
+        uri = os.getenv("MONGO_LOGS_URI")
+        if not uri:
+             logger.error("MONGO_LOGS_URI not set. Conversation memory will fail.")
+             raise ValueError("MONGO_LOGS_URI not set")
+
+        self.collection = get_client(uri).get_default_database()['conversation_memory']
+        # Raw turns always replayed verbatim, and how many extra turns trigger a fold
+        self.raw_turns = int(os.getenv("MEMORY_RAW_TURNS", "3"))
+        self.summary_every = int(os.getenv("MEMORY_SUMMARY_EVERY", "4"))
+
+    def get_state(self, session_id):
+        """
+        Returns {"summary": str, "summarized_count": int} for a session.
+        """
+        try:
+            doc = self.collection.find_one({"_id": session_id})
+        except Exception as e:
+            logger.error(f"Failed to load conversation memory: {e}")
+            doc = None
+        if not doc:
+            return {"summary": "", "summarized_count": 0}
+        return {"summary": doc.get("summary", ""), "summarized_count": doc.get("summarized_count", 0)}
+
+    def build_history(self, chat_history, state):
+        """
+        LLM messages: the running summary followed by every turn not folded into it yet.
+        """
+        # A shorter history means the session was reset; ignore the stale summary
+        start = state["summarized_count"] if state["summarized_count"] <= len(chat_history) else 0
+        history = []
+        if state["summary"] and start:
+            history.append({"role": "system", "content": f"Summary of the earlier conversation:\n{state['summary']}"})
+        history.extend({"role": m['role'], "content": m['content']} for m in chat_history[start:])
+        return history
+
+    def schedule_fold(self, session_id, chat_history, state, llm_service):
+        """
+        Once `summary_every` turns have piled up beyond the raw window, folds them into the
+        summary in the background. Returns True if a job was scheduled.
+        """
+        start = state["summarized_count"] if state["summarized_count"] <= len(chat_history) else 0
+        keep = self.raw_turns * 2
+        if len(chat_history) - start < keep + self.summary_every * 2:
+            return False
+
+        with _pending_lock:
+            if session_id in _pending_sessions:
+                return False
+            _pending_sessions.add(session_id)
+
+        end = len(chat_history) - keep
+        turns = list(chat_history[start:end])
+        summary = state["summary"] if start else ""
+        logger.info(f"Scheduling memory fold of {len(turns)} messages for session {session_id}")
+        _executor.submit(self._fold, session_id, summary, start, end, turns, llm_service)
+        return True
+
+    def _fold(self, session_id, summary, start, end, turns, llm_service):
+        try:
+            new_summary = llm_service.summarize_conversation(summary, turns)
+            # Only apply if nobody folded this session in the meantime
+            self.collection.update_one(
+                {"_id": session_id, "summarized_count": start},
+                {"$set": {"summary": new_summary, "summarized_count": end,
+                          "updated_at": datetime.datetime.utcnow()}},
+                upsert=True
+            )
+            logger.info(f"Conversation memory for session {session_id} now covers {end} messages")
+        except DuplicateKeyError:
+            logger.debug(f"Memory fold for session {session_id} superseded by another fold")
+        except Exception as e:
+            logger.error(f"Memory fold failed for session {session_id}: {e}")
+        finally:
+            with _pending_lock:
+                _pending_sessions.discard(session_id)
+
+    def clear(self, session_id):
+        try:
+            self.collection.delete_one({"_id": session_id})
+        except Exception as e:
+            logger.error(f"Failed to clear conversation memory: {e}")
@@ -1,21 +1,202 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, uri_parser
+from pymongo.errors import ExecutionTimeout
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
+import hashlib
 import json
+import os
+import threading
+import time
+from urllib.parse import parse_qsl
 from mongo_chat_platform.logger import logger
+from mongo_chat_platform.services.query_plan_service import QueryCompileError, QueryPlan, compile_query
+from mongo_chat_platform.services.result_summary_service import format_documents
+
+# Shared MongoClient pool keyed by URI. MongoClient is thread-safe and keeps its own
+# connection pool, so one instance per URI is reused across requests.
+_client_pool = {}
+_client_pool_lock = threading.Lock()
+
+# Short-lived cache of successful connection verifications: uri -> (verified_at, db_name)
+_verified_connections = {}
+
+# Collection catalog cache: (uri, db_name) -> (fetched_at, names)
+_collection_catalog = {}
+
+
+def _get_or_create_client(uri, **client_options):
+    """
+    Returns (client, created) for a URI, where `created` tells whether this call created it.
+    """
+    with _client_pool_lock:
+        client = _client_pool.get(uri)
+        if client is not None:
+            return client, False
+        logger.info(f"Creating pooled MongoClient for: {uri.split('@')[-1]}")
+        client = MongoClient(uri, **client_options)
+        _client_pool[uri] = client
+        return client, True
+
+
+def get_client(uri, **client_options):
+    """
+    Returns the pooled MongoClient for a URI, creating it on first use.
+    `client_options` only apply when the client is created.
+    """
+    return _get_or_create_client(uri, **client_options)[0]
+
+
+def discard_client(uri, client=None):
+    """
+    Closes and removes a pooled client. When `client` is given, only that instance is discarded,
+    so a stale reference cannot close a client that replaced it in the pool.
+    """
+    with _client_pool_lock:
+        pooled = _client_pool.get(uri)
+        if pooled is None or (client is not None and pooled is not client):
+            return
+        del _client_pool[uri]
+        _verified_connections.pop(uri, None)
+    pooled.close()
+
+
+def verify_connection(uri):
+    """
+    Pings the cluster and returns the URI's default database name (or None).
+    Successful verifications are cached for CONNECTION_VERIFY_TTL seconds and the verified
+    client stays in the pool, so the chat view reuses it instead of reconnecting.
+    Raises pymongo errors on failure.
+    """
+    ttl = int(os.getenv("CONNECTION_VERIFY_TTL", "60"))
+    cached = _verified_connections.get(uri)
+    if cached and time.monotonic() - cached[0] < ttl and uri in _client_pool:
+        logger.debug("Using cached connection verification")
+        return cached[1]
+
+    client, created = _get_or_create_client(uri, serverSelectionTimeoutMS=5000)
+    try:
+        client.admin.command('ping')
+    except Exception:
+        _verified_connections.pop(uri, None)
+        # A pooled client is shared by running chats, exports and indexing jobs:
+        # only a client created by this call is closed, never one others already hold
+        if created:
+            discard_client(uri, client)
+        raise
+
+    try:
+        db_name = client.get_default_database().name
+    except Exception:
+        db_name = None
+
+    _verified_connections[uri] = (time.monotonic(), db_name)
+    return db_name
+
+
+# URI options describing the whole deployment, dropped when connecting to a single member
+CLUSTER_URI_OPTIONS = {
+    "replicaset", "directconnection", "loadbalanced", "srvservicename", "srvmaxhosts",
+    "readpreference", "readpreferencetags", "maxstalenessseconds",
+}
+
+READ_PREFERENCE_MODES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+# Per-action server-side limits: (maxTimeMS, batchSize). Override with MONGO_MAX_TIME_MS_<ACTION>
+# and MONGO_BATCH_SIZE_<ACTION>; a maxTimeMS of 0 means no limit.
+DEFAULT_QUERY_LIMITS = {
+    "find": (5000, 20),
+    "aggregate": (15000, 101),
+    "count": (5000, None),
+    "distinct": (5000, None),
+    "export": (300000, 1000),
+}
+
+
+def load_read_preference():
+    """
+    Read preference for generated queries, from MONGO_READ_PREFERENCE (default secondaryPreferred),
+    MONGO_READ_PREFERENCE_TAGS ("nodeType:ANALYTICS,region:east;nodeType:ANALYTICS", tag sets split by ";")
+    and MONGO_MAX_STALENESS_SECONDS. Keeps chat load off the primary when secondaries exist.
+    """
+    mode_name = os.getenv("MONGO_READ_PREFERENCE", "secondaryPreferred")
+    mode = READ_PREFERENCE_MODES.get(mode_name)
+    if mode is None:
+        logger.error(f"Unknown MONGO_READ_PREFERENCE '{mode_name}', using secondaryPreferred")
+        mode = SecondaryPreferred
+    if mode is Primary:
+        return Primary()
+
+    tag_sets = []
+    for tag_set in os.getenv("MONGO_READ_PREFERENCE_TAGS", "").split(";"):
+        tags = dict(pair.split(":", 1) for pair in tag_set.split(",") if ":" in pair)
+        if tags:
+            tag_sets.append(tags)
+    max_staleness = int(os.getenv("MONGO_MAX_STALENESS_SECONDS", "-1"))
+    return mode(tag_sets=tag_sets or None, max_staleness=max_staleness)
+
+
+def query_limits(action):
+    """
+    Returns (max_time_ms, batch_size) for an action; None means "not set".
+    """
+    max_time_ms, batch_size = DEFAULT_QUERY_LIMITS[action]
+    max_time_ms = int(os.getenv(f"MONGO_MAX_TIME_MS_{action.upper()}", max_time_ms))
+    batch_size = os.getenv(f"MONGO_BATCH_SIZE_{action.upper()}", batch_size)
+    return max_time_ms or None, int(batch_size) if batch_size else None
+
+
+def allow_disk_use(action):
+    """
+    MONGO_ALLOW_DISK_USE policy: "never", "always", or "export" (default: only exports may spill to disk).
+    """
+    policy = os.getenv("MONGO_ALLOW_DISK_USE", "export")
+    return policy == "always" or (policy == "export" and action == "export")
+
+
+def operation_tag(value):
+    """
+    Non-reversible tag for a secret such as a session key.
+    """
+    return hashlib.sha256(value.encode()).hexdigest()[:16]
+
 
 class MongoService:
-    def __init__(self, uri, db_name=None):
+    def __init__(self, uri, db_name=None, op_tag=None):
+        """
+        A tag derived from `op_tag` (e.g. the session key) is attached as a comment to every generated query,
+        so running operations can be found and cancelled with `cancel_operations`. Only a truncated
+        hash is sent: comments show up in currentOp, the profiler and server logs.
+        """
         logger.info("Initializing MongoService")
-        self.client = MongoClient(uri)
+        self.uri = uri
+        self.client = get_client(uri)
+        read_preference = load_read_preference()
         if db_name:
-            self.db = self.client[db_name]
+            self.db = self.client.get_database(db_name, read_preference=read_preference)
         else:
-            self.db = self.client.get_default_database()
+            self.db = self.client.get_default_database(read_preference=read_preference)
+        self.comment = f"mongochat:{operation_tag(op_tag)}" if op_tag else "mongochat"
+
+    def get_collection_names(self, refresh=False):
+        """
+        Lists collections, served from a catalog cache for COLLECTION_CATALOG_TTL seconds.
+        """
+        ttl = int(os.getenv("COLLECTION_CATALOG_TTL", "300"))
+        cache_key = (self.uri, self.db.name)
+        cached = _collection_catalog.get(cache_key)
+        if cached and not refresh and time.monotonic() - cached[0] < ttl:
+            return list(cached[1])
 
-    def get_collection_names(self):
         try:
             names = self.db.list_collection_names()
+            _collection_catalog[cache_key] = (time.monotonic(), names)
             logger.debug(f"Retrieved {len(names)} collections: {names}")
-            return names
+            return list(names)
         except Exception as e:
             logger.error(f"Failed to list collection names: {e}")
             raise e
@@ -38,8 +219,8 @@ class MongoService:
 
     def execute_tool_query(self, tool_input):
         """
-        Executes a parsed JSON query action.
-        Expected format:
+        Executes a compiled QueryPlan (see query_plan_service), or a raw tool dict which is compiled first.
+        Expected raw format:
         {
             "collection": "str",
             "action": "find/aggregate/count/distinct",
@@ -47,58 +228,156 @@ class MongoService:
             "limit": int (optional)
         }
         """
-        collection = tool_input.get('collection')
-        action = tool_input.get('action')
-        query = tool_input.get('query', {})
-        
-        logger.info(f"Executing tool action: {action} on {collection}")
-        
-        if not collection or collection not in self.get_collection_names():
-            return f"Error: Collection '{collection}' does not exist."
+        if isinstance(tool_input, QueryPlan):
+            plan = tool_input
+        else:
+            try:
+                plan = compile_query(tool_input, self.get_collection_names())
+            except QueryCompileError as e:
+                return f"Error: {e}"
+
+        logger.info(f"Executing tool action: {plan.action} on {plan.collection}")
+
+        col_obj = self.db[plan.collection]
+        query = plan.query
+        notes = "".join(f"\nNote: {w}" for w in plan.warnings)
 
-        col_obj = self.db[collection]
+        max_time_ms, batch_size = query_limits(plan.action)
+        options = {"comment": self.comment}
+        if max_time_ms:
+            options["maxTimeMS"] = max_time_ms
 
         try:
-            if action == 'find':
-                limit = tool_input.get('limit', 5)
-                # Ensure limit is reasonable
-                limit = min(limit, 20)
-                cursor = col_obj.find(query).limit(limit)
+            if plan.action == 'find':
+                cursor = col_obj.find(query, plan.projection, batch_size=batch_size or 0, comment=self.comment,
+                                      max_time_ms=max_time_ms).limit(plan.limit)
                 results = list(cursor)
-                formatted = json.dumps(results, default=str)
-                return f"Found {len(results)} documents: {formatted}"
+                formatted = format_documents(results, plan.action, plan.limit)
+                return f"Found {len(results)} documents: {formatted}{notes}"
             
-            elif action == 'aggregate':
-                if not isinstance(query, list):
-                    return "Error: Aggregation pipeline must be a list."
-                # Safety: Basic check to prevent modifications (though user should be read-only ideally)
-                unsafe_stages = ['$out', '$merge']
-                for stage in query:
-                    if any(k in unsafe_stages for k in stage.keys()):
-                        return "Error: Write operations ($out, $merge) are not allowed."
-                
-                results = list(col_obj.aggregate(query))
-                formatted = json.dumps(results, default=str)
-                return f"Aggregation Result: {formatted}"
+            elif plan.action == 'aggregate':
+                if batch_size:
+                    options["batchSize"] = batch_size
+                results = list(col_obj.aggregate(query, allowDiskUse=allow_disk_use(plan.action), **options))
+                formatted = format_documents(results, plan.action)
+                return f"Aggregation Result: {formatted}{notes}"
             
-            elif action == 'count':
-                count = col_obj.count_documents(query)
-                return f"Count: {count}"
+            elif plan.action == 'count':
+                count = col_obj.count_documents(query, **options)
+                return f"Count: {count}{notes}"
             
-            elif action == 'distinct':
-                field = tool_input.get('field')
-                if not field:
-                    return "Error: 'field' required for distinct."
-                results = col_obj.distinct(field, query)
-                return f"Distinct values for '{field}': {results[:50]}" # Limit output
+            elif plan.action == 'distinct':
+                results = col_obj.distinct(plan.field, query, **options)
+                return f"Distinct values for '{plan.field}': {results[:50]}{notes}" # Limit output
 
             else:
-                return f"Error: Unknown action '{action}'."
+                return f"Error: Unknown action '{plan.action}'."
 
+        except ExecutionTimeout:
+            logger.warning(f"Tool query on {plan.collection} exceeded maxTimeMS={max_time_ms}")
+            return (f"Database Error: The query exceeded the {max_time_ms}ms time limit. "
+                    f"Use a more selective filter or a smaller pipeline.")
         except Exception as e:
             logger.error(f"Tool execution failed: {e}")
             return f"Database Error: {str(e)}"
 
+    def iter_plan_documents(self, plan, projection=None, batch_size=None):
+        """
+        Returns an iterator over every document a find/aggregate plan matches, without the chat row cap.
+        The query runs and its first batch is fetched before this returns, so query errors
+        (OperationFailure, ExecutionTimeout) are raised here rather than mid-stream.
+        The cursor is fetched in `batch_size` batches and closed when the consumer stops
+        (including a client disconnect closing the streaming response), which kills it on the server.
+        """
+        max_time_ms, default_batch_size = query_limits("export")
+        batch_size = batch_size or default_batch_size or 0
+        options = {"comment": self.comment}
+        if max_time_ms:
+            options["maxTimeMS"] = max_time_ms
+
+        col_obj = self.db[plan.collection]
+        if plan.action == 'find':
+            cursor = col_obj.find(plan.query, projection or plan.projection, batch_size=batch_size,
+                                  comment=self.comment, max_time_ms=max_time_ms)
+        elif plan.action == 'aggregate':
+            pipeline = list(plan.query)
+            if projection:
+                pipeline.append({"$project": projection})
+            if batch_size:
+                options["batchSize"] = batch_size
+            cursor = col_obj.aggregate(pipeline, allowDiskUse=allow_disk_use("export"), **options)
+        else:
+            raise ValueError(f"Action '{plan.action}' cannot be exported.")
+
+        logger.info(f"Exporting {plan.action} results from {plan.collection} (batch size: {batch_size})")
+        try:
+            first = next(cursor, None)
+        except Exception:
+            cursor.close()
+            raise
+        return self._drain_cursor(cursor, first)
+
+    @staticmethod
+    def _drain_cursor(cursor, first):
+        try:
+            if first is not None:
+                yield first
+            yield from cursor
+        finally:
+            cursor.close()
+
+    def cancel_operations(self):
+        """
+        Kills running operations started by this service's tag (e.g. after the client went away).
+        Generated queries may run on any replica set member (see load_read_preference), so
+        $currentOp/killOp are run on every known member over a direct connection.
+        Returns the number of operations killed.
+        """
+        killed = 0
+        for node in list(self.client.nodes) or [None]:
+            member = self._direct_client(*node) if node else self.client
+            try:
+                killed += self._kill_tagged_operations(member.admin)
+            except Exception as e:
+                logger.error(f"Failed to cancel operations for {self.comment} on {node or 'primary'}: {e}")
+            finally:
+                if member is not self.client:
+                    member.close()
+        if killed:
+            logger.info(f"Cancelled {killed} running operations for {self.comment}")
+        return killed
+
+    def _direct_client(self, host, port):
+        """
+        Short-lived client connected to a single member, with the URI's credentials, auth and TLS options.
+        """
+        parsed = uri_parser.parse_uri(self.uri)
+        query = self.uri.split("?", 1)[1] if "?" in self.uri else ""
+        # Raw URI values: parse_uri's are already converted (e.g. timeouts to seconds)
+        options = {"serverSelectionTimeoutMS": 5000}
+        options.update((key, value) for key, value in parse_qsl(query) if key.lower() not in CLUSTER_URI_OPTIONS)
+        if self.uri.startswith("mongodb+srv://"):
+            # Implied by SRV/TXT records, which a direct connection does not read
+            if not any(key.lower() in ("tls", "ssl") for key in options):
+                options["tls"] = True
+            if "authSource" in parsed["options"] and not any(key.lower() == "authsource" for key in options):
+                options["authSource"] = parsed["options"]["authSource"]
+        return MongoClient(host, port, username=parsed["username"], password=parsed["password"],
+                           directConnection=True, **options)
+
+    def _kill_tagged_operations(self, admin):
+        killed = 0
+        # getMore batches of a tagged cursor carry the tag on the originating command
+        ops = admin.aggregate([
+            {"$currentOp": {"allUsers": False, "idleConnections": False}},
+            {"$match": {"$or": [{"command.comment": self.comment},
+                                {"cursor.originatingCommand.comment": self.comment}]}},
+        ])
+        for op in ops:
+            admin.command("killOp", op=op["opid"])
+            killed += 1
+        return killed
+
     def extract_schema_info(self):
         """
         Generates a summary of all collections and their sample structure.
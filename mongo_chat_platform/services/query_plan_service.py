@@ -0,0 +1,301 @@
+import copy
+import dataclasses
+import datetime
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from bson import ObjectId
+from bson.errors import InvalidId
+from mongo_chat_platform.logger import logger
+from mongo_chat_platform.services.retrieval_service import OBJECT_ID_PATTERN, get_lexical_index
+
+ACTIONS = {"find", "count", "aggregate", "distinct"}
+MAX_FIND_LIMIT = 20
+
+# Forbidden anywhere in a query or pipeline: writes and server-side JavaScript
+FORBIDDEN_OPERATORS = {"$out", "$merge", "$function", "$accumulator", "$where"}
+
+QUERY_OPERATORS = {
+    "$eq", "$ne", "$gt", "$gte", "$lt", "$lte", "$in", "$nin",
+    "$and", "$or", "$nor", "$not", "$exists", "$type", "$expr", "$jsonSchema", "$mod", "$regex", "$options",
+    "$text", "$search", "$language", "$caseSensitive", "$diacriticSensitive",
+    "$geoIntersects", "$geoWithin", "$near", "$nearSphere", "$geometry", "$maxDistance", "$minDistance",
+    "$all", "$elemMatch", "$size", "$bitsAllClear", "$bitsAllSet", "$bitsAnyClear", "$bitsAnySet",
+    "$comment",
+}
+LOGICAL_OPERATORS = {"$and", "$or", "$nor"}
+
+READ_STAGES = {
+    "$addFields", "$bucket", "$bucketAuto", "$collStats", "$count", "$densify", "$documents", "$facet",
+    "$fill", "$geoNear", "$graphLookup", "$group", "$indexStats", "$limit", "$lookup", "$match",
+    "$project", "$redact", "$replaceRoot", "$replaceWith", "$sample", "$search", "$searchMeta", "$set",
+    "$setWindowFields", "$skip", "$sort", "$sortByCount", "$unionWith", "$unset", "$unwind",
+}
+
+
+class QueryCompileError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class QueryPlan:
+    """
+    A validated, normalized tool query ready for MongoService.execute_tool_query.
+    """
+    collection: str
+    action: str
+    query: object
+    limit: int = 5
+    field: str = None
+    projection: dict = None
+    warnings: tuple = ()
+    fingerprint: str = ""
+
+    def to_dict(self):
+        """
+        JSON-serializable form of the plan (BSON values as extended JSON), e.g. for the session.
+        """
+        return {
+            "collection": self.collection,
+            "action": self.action,
+            "query": json.loads(json.dumps(self.query, default=_to_extended_json)),
+            "limit": self.limit,
+            "field": self.field,
+            "projection": self.projection,
+        }
+
+
+def _to_extended_json(value):
+    if isinstance(value, ObjectId):
+        return {"$oid": str(value)}
+    if isinstance(value, datetime.datetime):
+        return {"$date": value.isoformat()}
+    return str(value)
+
+
+def schema_types(db_name):
+    """
+    Returns {collection: {field_path: type_name}} from the indexed schema of a database.
+    """
+    index = get_lexical_index(db_name, create=False) if db_name else None
+    if not index:
+        return {}
+    return {col: {path: type_name for path, type_name, _ in fields} for col, fields in index.fields.items()}
+
+
+class QueryPlanCompiler:
+    """
+    Compiles the LLM's tool JSON into a QueryPlan:
+    parses, coerces extended JSON and schema-typed values (dates, ObjectIds), validates
+    actions/operators/stages, flags unknown field paths, and caches compiled plans by hash.
+    """
+    def __init__(self, cache_size=256):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def compile(self, tool_input, collections, schema=None):
+        """
+        `tool_input` is the raw tool JSON string or an already parsed dict.
+        `collections` lists existing collections, `schema` is {collection: {path: type}}.
+        Raises QueryCompileError on invalid input.
+        """
+        if isinstance(tool_input, str):
+            try:
+                tool_input = json.loads(tool_input)
+            except json.JSONDecodeError as e:
+                raise QueryCompileError(f"Invalid JSON format: {e}")
+        if not isinstance(tool_input, dict):
+            raise QueryCompileError("Tool input must be a JSON object.")
+
+        schema = schema or {}
+        collection = tool_input.get('collection')
+        fields = schema.get(collection, {})
+        cache_key = hashlib.sha256(
+            json.dumps([tool_input, sorted(collections), sorted(fields.items())], sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+        with self._lock:
+            plan = self._cache.get(cache_key)
+            if plan is not None:
+                self._cache.move_to_end(cache_key)
+                logger.debug(f"Query plan cache hit: {cache_key[:12]}")
+                return self._copy(plan)
+
+        plan = self._compile(tool_input, collections, fields, cache_key)
+        with self._lock:
+            self._cache[cache_key] = plan
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return self._copy(plan)
+
+    @staticmethod
+    def _copy(plan):
+        # QueryPlan is frozen, but its query/projection are not: callers get their own copies
+        return dataclasses.replace(plan, query=copy.deepcopy(plan.query), projection=copy.deepcopy(plan.projection))
+
+    def _compile(self, tool_input, collections, fields, fingerprint):
+        collection = tool_input.get('collection')
+        action = tool_input.get('action')
+        query = tool_input.get('query', {})
+        warnings = []
+
+        if not collection or collection not in collections:
+            raise QueryCompileError(f"Collection '{collection}' does not exist.")
+        if action not in ACTIONS:
+            raise QueryCompileError(f"Unknown action '{action}'. Expected one of: {', '.join(sorted(ACTIONS))}.")
+
+        self._check_forbidden(query)
+        query = self._coerce_extended_json(query)
+
+        if action == 'aggregate':
+            if not isinstance(query, list):
+                raise QueryCompileError("Aggregation pipeline must be a list.")
+            query = [self._compile_stage(stage, fields, warnings) for stage in query]
+        else:
+            if query is None:
+                query = {}
+            if not isinstance(query, dict):
+                raise QueryCompileError(f"'{action}' query must be a filter object.")
+            query = self._compile_filter(query, fields, warnings)
+
+        field_name = tool_input.get('field')
+        if action == 'distinct':
+            if not field_name or not isinstance(field_name, str):
+                raise QueryCompileError("'field' required for distinct.")
+            self._check_path(field_name, fields, warnings)
+
+        try:
+            limit = int(tool_input.get('limit') or 5)
+        except (TypeError, ValueError):
+            raise QueryCompileError(f"Invalid limit: {tool_input.get('limit')!r}")
+        limit = max(1, min(limit, MAX_FIND_LIMIT))
+
+        projection = tool_input.get('projection')
+        if projection is not None and not isinstance(projection, dict):
+            raise QueryCompileError("'projection' must be an object.")
+
+        if warnings:
+            logger.warning(f"Query plan warnings for {collection}: {warnings}")
+        return QueryPlan(collection=collection, action=action, query=query, limit=limit, field=field_name,
+                         projection=projection, warnings=tuple(warnings), fingerprint=fingerprint)
+
+    def _check_forbidden(self, value):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                if key in FORBIDDEN_OPERATORS:
+                    raise QueryCompileError(f"Operator '{key}' is not allowed (read-only access).")
+                self._check_forbidden(item)
+        elif isinstance(value, list):
+            for item in value:
+                self._check_forbidden(item)
+
+    def _coerce_extended_json(self, value):
+        """
+        Converts {"$oid": ...} and {"$date": ...} wrappers into BSON values, at any depth.
+        """
+        if isinstance(value, dict):
+            if len(value) == 1 and "$oid" in value:
+                return self._to_object_id(value["$oid"])
+            if len(value) == 1 and "$date" in value:
+                return self._to_datetime(value["$date"])
+            return {k: self._coerce_extended_json(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self._coerce_extended_json(v) for v in value]
+        return value
+
+    def _compile_stage(self, stage, fields, warnings):
+        if not isinstance(stage, dict) or len(stage) != 1:
+            raise QueryCompileError(f"Each pipeline stage must be an object with exactly one stage operator: {stage}")
+        name, spec = next(iter(stage.items()))
+        if name not in READ_STAGES:
+            raise QueryCompileError(f"Unsupported pipeline stage '{name}'.")
+        if name == "$match":
+            if not isinstance(spec, dict):
+                raise QueryCompileError("$match requires a filter object.")
+            spec = self._compile_filter(spec, fields, warnings)
+        return {name: spec}
+
+    def _compile_filter(self, query, fields, warnings):
+        compiled = {}
+        for key, value in query.items():
+            if key.startswith('$'):
+                if key not in QUERY_OPERATORS:
+                    raise QueryCompileError(f"Unknown query operator '{key}'.")
+                if key in LOGICAL_OPERATORS:
+                    if not isinstance(value, list) or not all(isinstance(sub, dict) for sub in value):
+                        raise QueryCompileError(f"'{key}' requires a list of filters.")
+                    value = [self._compile_filter(sub, fields, warnings) for sub in value]
+                compiled[key] = value
+            else:
+                self._check_path(key, fields, warnings)
+                compiled[key] = self._coerce_value(value, self._field_type(key, fields))
+        return compiled
+
+    def _coerce_value(self, value, type_name):
+        """
+        Converts string literals to the schema type of the field they are compared with.
+        """
+        if isinstance(value, dict):
+            for op in value:
+                if op.startswith('$') and op not in QUERY_OPERATORS:
+                    raise QueryCompileError(f"Unknown query operator '{op}'.")
+            return {op: self._coerce_value(v, type_name) if op not in ("$regex", "$options", "$exists", "$type", "$size")
+                    else v for op, v in value.items()}
+        if isinstance(value, list):
+            return [self._coerce_value(v, type_name) for v in value]
+        if isinstance(value, str):
+            if type_name == "date":
+                try:
+                    return self._to_datetime(value)
+                except QueryCompileError:
+                    return value
+            if type_name == "objectId" and OBJECT_ID_PATTERN.match(value):
+                return ObjectId(value)
+        return value
+
+    @staticmethod
+    def _field_type(path, fields):
+        if path == "_id":
+            return fields.get("_id", "objectId")
+        return fields.get(path)
+
+    @staticmethod
+    def _check_path(path, fields, warnings):
+        if not fields or path == "_id" or path in fields:
+            return
+        # Positional/array paths ("items.0.price", "items.$.price") resolve to the array's element fields
+        normalized = ".".join(p for p in path.split(".") if not p.isdigit() and not p.startswith("$"))
+        if normalized in fields:
+            return
+        known = ", ".join(sorted(p for p in fields if "." not in p))
+        warnings.append(f"Field '{path}' not found in the schema sample (known top-level fields: {known}).")
+
+    @staticmethod
+    def _to_object_id(value):
+        try:
+            return ObjectId(value)
+        except (InvalidId, TypeError):
+            raise QueryCompileError(f"Invalid ObjectId: {value!r}")
+
+    @staticmethod
+    def _to_datetime(value):
+        if isinstance(value, dict) and "$numberLong" in value:
+            value = int(value["$numberLong"])
+        if isinstance(value, (int, float)):
+            return datetime.datetime.fromtimestamp(value / 1000, tz=datetime.timezone.utc)
+        if isinstance(value, str):
+            try:
+                return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+            except ValueError:
+                pass
+        raise QueryCompileError(f"Invalid date: {value!r}")
+
+
+query_plan_compiler = QueryPlanCompiler()
+
+
+def compile_query(tool_input, collections, schema=None):
+    return query_plan_compiler.compile(tool_input, collections, schema)
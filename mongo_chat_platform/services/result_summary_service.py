@@ -0,0 +1,135 @@
+import datetime
+import json
+import os
+from collections import Counter
+import numpy as np
+from mongo_chat_platform.logger import logger
+
+
+def _flatten(doc, prefix=""):
+    """
+    Flattens nested objects into dotted paths; arrays are kept as values.
+    """
+    flat = {}
+    for key, value in doc.items():
+        path = f"{prefix}.{key}" if prefix else str(key)
+        if isinstance(value, dict) and value:
+            flat.update(_flatten(value, path))
+        else:
+            flat[path] = value
+    return flat
+
+
+def _is_number(value):
+    return isinstance(value, (int, float, np.number)) and not isinstance(value, bool)
+
+
+def _fmt(number):
+    return f"{number:.4g}" if isinstance(number, float) else str(number)
+
+
+def _short(value, width=40):
+    text = json.dumps(value, default=str) if isinstance(value, (dict, list)) else str(value)
+    return text if len(text) <= width else text[:width - 3] + "..."
+
+
+def _summarize_column(path, values, n_rows, top_k):
+    present = [v for v in values if v is not None]
+    nulls = n_rows - len(present)
+    if not present:
+        return f"{path}: all null"
+
+    numbers = [v for v in present if _is_number(v)]
+    if len(numbers) == len(present):
+        arr = np.asarray(numbers, dtype=np.float64)
+        p25, p50, p75 = np.percentile(arr, [25, 50, 75])
+        return (f"{path} (number, {nulls} null): min {_fmt(float(arr.min()))}, max {_fmt(float(arr.max()))}, "
+                f"mean {_fmt(float(arr.mean()))}, p25 {_fmt(float(p25))}, p50 {_fmt(float(p50))}, "
+                f"p75 {_fmt(float(p75))}, sum {_fmt(float(arr.sum()))}")
+
+    if all(isinstance(v, datetime.datetime) for v in present):
+        return f"{path} (date, {nulls} null): min {min(present)}, max {max(present)}"
+
+    if all(isinstance(v, list) for v in present):
+        lengths = np.fromiter((len(v) for v in present), dtype=np.int64, count=len(present))
+        return (f"{path} (array, {nulls} null): length min {lengths.min()}, max {lengths.max()}, "
+                f"mean {_fmt(float(lengths.mean()))}")
+
+    counts = Counter(_short(v) for v in present)
+    if len(counts) == len(present) and len(present) > top_k:
+        examples = ", ".join(list(counts)[:2])
+        return f"{path} ({nulls} null): {len(counts)} unique values, e.g. {examples}"
+    top = ", ".join(f"{value} x{count}" for value, count in counts.most_common(top_k))
+    return f"{path} ({nulls} null): {len(counts)} distinct; top: {top}"
+
+
+def _truncated_row(row):
+    return {path: value if _is_number(value) or isinstance(value, bool) or value is None else _short(value)
+            for path, value in row.items()}
+
+
+def summarize_documents(documents, top_k=5, max_chars=None):
+    """
+    Compact columnar statistics of query results for the LLM: per-field numeric
+    min/max/mean/percentiles/sum, date ranges, top-k categories and null counts.
+    With `max_chars`, fields that do not fit are left out and counted instead.
+    """
+    rows = [_flatten(doc) if isinstance(doc, dict) else {"value": doc} for doc in documents]
+    n_rows = len(rows)
+    columns = list(dict.fromkeys(path for row in rows for path in row))
+
+    lines = [f"{n_rows} documents, {len(columns)} fields."]
+    used = len(lines[0])
+    for i, path in enumerate(columns):
+        line = "- " + _summarize_column(path, [row.get(path) for row in rows], n_rows, top_k)
+        # Room for this line plus the "more fields" note
+        if max_chars is not None and used + len(line) + 40 > max_chars:
+            lines.append(f"- ... {len(columns) - i} more fields")
+            break
+        lines.append(line)
+        used += len(line) + 1
+    return "\n".join(lines)
+
+
+OMITTED_NOTE = "\n{} more rows omitted (the full result can be exported)."
+
+
+def _fit_rows(rows, max_chars):
+    """
+    Truncated rows as a JSON list, as many as fit in `max_chars`; returns (json, omitted count).
+    """
+    kept = []
+    used = 2
+    for row in rows:
+        text = json.dumps(_truncated_row(row), default=str)
+        if used + len(text) + 2 > max_chars:
+            break
+        kept.append(text)
+        used += len(text) + 2
+    return "[" + ", ".join(kept) + "]", len(rows) - len(kept)
+
+
+def format_documents(documents, action="find", limit=None):
+    """
+    Formats tool results (up to `limit` rows) for the second LLM pass, within RESULT_SUMMARY_MAX_CHARS:
+    - results that fit go in as raw JSON;
+    - larger `find` results become column statistics plus as many rows (long values cut) as fit;
+    - larger `aggregate` results are already reduced (groups, counts), so they only get their values cut.
+    Rows that do not fit are counted in an explicit "omitted" note.
+    """
+    if limit is not None:
+        documents = documents[:limit]
+    raw = json.dumps(documents, default=str)
+    budget = int(os.getenv("RESULT_SUMMARY_MAX_CHARS", "4000"))
+    if len(raw) <= budget:
+        return raw
+
+    header = summarize_documents(documents, max_chars=budget // 2) + "\n" if action != "aggregate" else ""
+    header += "Rows (long values truncated): "
+    rows, omitted = _fit_rows([_flatten(doc) if isinstance(doc, dict) else {"value": doc} for doc in documents],
+                              budget - len(header) - len(OMITTED_NOTE.format(len(documents))))
+    formatted = header + rows
+    if omitted:
+        formatted += OMITTED_NOTE.format(omitted)
+    logger.debug(f"Formatted {len(documents)} documents into {len(formatted)} chars (raw: {len(raw)})")
+    return formatted
@@ -0,0 +1,244 @@
+import json
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+from mongo_chat_platform.logger import logger
+from mongo_chat_platform.services.vector_replica import is_older_generation
+
+STOPWORDS = {
+    "a", "an", "the", "of", "in", "on", "for", "to", "and", "or", "is", "are", "was", "were", "be",
+    "by", "with", "from", "at", "as", "me", "my", "i", "you", "it", "its", "this", "that", "all",
+    "how", "many", "much", "what", "which", "who", "show", "list", "give", "get", "find", "there",
+    "do", "does", "did", "have", "has", "per", "each", "top",
+}
+
+# Reranker weights: vector similarity, normalized BM25 score, collection name overlap
+VECTOR_WEIGHT = 0.5
+LEXICAL_WEIGHT = 0.3
+NAME_WEIGHT = 0.2
+
+
+def _stem(token):
+    if len(token) > 4 and token.endswith("ies"):
+        return token[:-3] + "y"
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+
+def tokenize(text):
+    """
+    Splits identifiers and free text into lowercase stemmed terms.
+    Handles camelCase, snake_case and dotted field paths ("orderItems.unit_price" -> order, item, unit, price).
+    """
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", text or "")
+    terms = re.split(r"[^A-Za-z0-9]+", text.lower())
+    return [_stem(t) for t in terms if t and t not in STOPWORDS]
+
+
+OBJECT_ID_PATTERN = re.compile(r"^[0-9a-fA-F]{24}$")
+# Exactly how BSON dates come out of the sample's json.dumps(default=str): str(datetime), space-separated.
+# ISO strings stored as strings ("2024-01-01T10:00:00Z") stay strings, so queries on them are not coerced.
+DATETIME_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}(\.\d{6})?([+-]\d{2}:\d{2})?$")
+
+
+def infer_type(value):
+    """
+    Infers the BSON type name of a value from a JSON sample (dates and ObjectIds arrive as strings).
+    """
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int):
+        return "int"
+    if isinstance(value, float):
+        return "double"
+    if isinstance(value, dict):
+        return "object"
+    if isinstance(value, list):
+        return "array"
+    if isinstance(value, str):
+        if OBJECT_ID_PATTERN.match(value):
+            return "objectId"
+        if DATETIME_PATTERN.match(value):
+            return "date"
+    return "string"
+
+
+def extract_fields(schema_str, prefix=""):
+    """
+    Returns [(dotted_path, type_name, example)] for every field of a JSON sample document.
+    Arrays are described by their first element, matching MongoDB's dot notation into arrays.
+    """
+    try:
+        doc = json.loads(schema_str) if isinstance(schema_str, str) else schema_str
+    except (TypeError, ValueError):
+        return []
+
+    fields = []
+    if isinstance(doc, dict):
+        for key, value in doc.items():
+            path = f"{prefix}.{key}" if prefix else key
+            example = "" if isinstance(value, (dict, list)) else str(value)[:60]
+            fields.append((path, infer_type(value), example))
+            fields.extend(extract_fields(value, path))
+    elif isinstance(doc, list) and doc:
+        fields.extend(extract_fields(doc[0], prefix))
+    return fields
+
+
+def format_field(path, type_name, example=""):
+    """
+    Renders one field for the prompt, e.g. "- items.unitPrice: double (e.g. 2.5)".
+    """
+    return f"- {path}: {type_name} (e.g. {example})" if example else f"- {path}: {type_name}"
+
+
+class LexicalSchemaIndex:
+    """
+    In-memory BM25 inverted index over collection and field names of one database.
+    `generation` is the index generation (see IndexStatusStore) it was built from.
+    """
+    k1 = 1.5
+    b = 0.75
+
+    def __init__(self, generation=None):
+        self.generation = generation
+        self._lock = threading.Lock()
+        self.fields = {}           # collection -> [(path, type_name, example)]
+        self.metadatas = {}        # collection -> metadata
+        self.term_freqs = {}       # collection -> Counter(term -> tf)
+        self.postings = defaultdict(set)  # term -> {collection}
+
+    def add(self, collection_name, fields, metadata):
+        # Collection name terms are counted twice: they are the strongest signal
+        name_terms = tokenize(collection_name)
+        field_terms = [t for path, _, _ in fields for t in tokenize(path)]
+        tf = Counter(name_terms * 2 + field_terms)
+
+        with self._lock:
+            self._remove(collection_name)
+            self.fields[collection_name] = list(fields)
+            self.metadatas[collection_name] = metadata
+            self.term_freqs[collection_name] = tf
+            for term in tf:
+                self.postings[term].add(collection_name)
+
+    def remove(self, collection_name):
+        with self._lock:
+            self._remove(collection_name)
+
+    def _remove(self, collection_name):
+        for term in self.term_freqs.pop(collection_name, {}):
+            self.postings[term].discard(collection_name)
+        self.fields.pop(collection_name, None)
+        self.metadatas.pop(collection_name, None)
+
+    def __len__(self):
+        return len(self.term_freqs)
+
+    def search(self, query, n_results=10):
+        """
+        Returns [(collection, bm25_score)] ordered by score, best first.
+        """
+        terms = set(tokenize(query))
+        with self._lock:
+            n_docs = len(self.term_freqs)
+            if not n_docs or not terms:
+                return []
+            avg_len = sum(sum(tf.values()) for tf in self.term_freqs.values()) / n_docs
+
+            scores = defaultdict(float)
+            for term in terms:
+                matches = self.postings.get(term)
+                if not matches:
+                    continue
+                idf = math.log(1 + (n_docs - len(matches) + 0.5) / (len(matches) + 0.5))
+                for col in matches:
+                    tf = self.term_freqs[col]
+                    freq = tf[term]
+                    doc_len = sum(tf.values())
+                    scores[col] += idf * freq * (self.k1 + 1) / (freq + self.k1 * (1 - self.b + self.b * doc_len / avg_len))
+
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:n_results]
+
+    def get_metadata(self, collection_name):
+        return self.metadatas.get(collection_name)
+
+    def matching_fields(self, collection_name, query, limit=10):
+        """
+        Returns the fields of a collection whose path shares a term with the query.
+        """
+        terms = set(tokenize(query))
+        fields = self.fields.get(collection_name, [])
+        return [f for f in fields if terms & set(tokenize(f[0]))][:limit]
+
+
+_lexical_indexes = {}
+_lexical_indexes_lock = threading.Lock()
+
+
+def get_lexical_index(db_name, create=True):
+    with _lexical_indexes_lock:
+        index = _lexical_indexes.get(db_name)
+        if index is None and create:
+            index = LexicalSchemaIndex()
+            _lexical_indexes[db_name] = index
+        return index
+
+
+def set_lexical_index(db_name, index):
+    """
+    Installs a rebuilt index, unless it is older than the installed one
+    (a rebuild that read the schema before a newer index run finished). Returns the installed index.
+    """
+    with _lexical_indexes_lock:
+        current = _lexical_indexes.get(db_name)
+        if current is not None and is_older_generation(index.generation, current.generation):
+            logger.info(f"Dropping lexical schema index for {db_name} from generation {index.generation}, "
+                        f"generation {current.generation} is already installed")
+            return current
+        _lexical_indexes[db_name] = index
+        return index
+
+
+def rerank(query, candidates, top_k=5):
+    """
+    Scores merged vector/lexical candidates and keeps the best `top_k`.
+
+    `candidates` maps collection -> {"document", "metadata", "distance" (or None), "bm25" (or 0)}.
+    Distances are min-max normalized, so cosine and L2 collections rank the same way.
+    Returns [(document, metadata)] best first.
+    """
+    if not candidates:
+        return []
+
+    query_terms = set(tokenize(query))
+    max_bm25 = max(c["bm25"] for c in candidates.values()) or 1.0
+    distances = [c["distance"] for c in candidates.values() if c["distance"] is not None]
+    min_dist, max_dist = (min(distances), max(distances)) if distances else (0.0, 0.0)
+    query_lower = (query or "").lower()
+
+    scored = []
+    for col, c in candidates.items():
+        if c["distance"] is None:
+            vector_sim = 0.0
+        elif max_dist > min_dist:
+            vector_sim = (max_dist - c["distance"]) / (max_dist - min_dist)
+        else:
+            vector_sim = 1.0
+        name_terms = set(tokenize(col))
+        if col.lower() in query_lower:
+            name_match = 1.0
+        elif name_terms:
+            name_match = len(name_terms & query_terms) / len(name_terms)
+        else:
+            name_match = 0.0
+        score = VECTOR_WEIGHT * vector_sim + LEXICAL_WEIGHT * c["bm25"] / max_bm25 + NAME_WEIGHT * name_match
+        scored.append((score, col))
+
+    scored.sort(reverse=True)
+    logger.debug(f"Reranked {len(scored)} schema candidates: {[(col, round(s, 3)) for s, col in scored[:top_k]]}")
+    return [(candidates[col]["document"], candidates[col]["metadata"]) for _, col in scored[:top_k]]
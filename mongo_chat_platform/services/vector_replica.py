@@ -0,0 +1,169 @@
+import datetime
+import json
+import os
+import re
+import threading
+import numpy as np
+from mongo_chat_platform.logger import logger
+
+
+class SchemaVectorReplica:
+    """
+    Local copy of one database's schema chunk embeddings as a contiguous, L2-normalized
+    float32 matrix, answering cosine top-k queries without a round trip to ChromaDB.
+    `generation` is the index generation (see IndexStatusStore) the replica was built from.
+    """
+    def __init__(self, db_name, ids, embeddings, documents, metadatas, mtime=None, generation=None):
+        self.db_name = db_name
+        self.ids = ids
+        self.embeddings = embeddings
+        self.documents = documents
+        self.metadatas = metadatas
+        self.mtime = mtime
+        self.generation = generation
+
+    def __len__(self):
+        return len(self.ids)
+
+    def query(self, query_embedding, n_results=10):
+        """
+        Returns (documents, metadatas, cosine distances), nearest first.
+        """
+        q = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(q)
+        if norm:
+            q = q / norm
+
+        similarities = self.embeddings @ q
+        k = min(n_results, len(similarities))
+        if k == 0:
+            return [], [], []
+        # argpartition is O(n); only the k winners get sorted
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top])]
+        return (
+            [self.documents[i] for i in top],
+            [self.metadatas[i] for i in top],
+            [float(1.0 - similarities[i]) for i in top],
+        )
+
+
+def is_older_generation(generation, current):
+    """
+    True if `generation` predates `current`; None is older than any generation.
+    """
+    return current is not None and (generation is None or generation < current)
+
+
+def _normalize(embeddings):
+    matrix = np.ascontiguousarray(np.asarray(embeddings, dtype=np.float32))
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class ReplicaStore:
+    """
+    Per-database replicas kept in memory. When SCHEMA_REPLICA_DIR is set, replicas are also
+    written there and loaded memory-mapped, so worker processes share one copy of the matrix
+    and pick up refreshes made by other processes (e.g. `refresh_schemas`).
+    """
+    def __init__(self, directory=None):
+        self.directory = directory if directory is not None else os.getenv("SCHEMA_REPLICA_DIR")
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._put_lock = threading.Lock()
+        self._replicas = {}
+
+    def _paths(self, db_name):
+        safe_name = re.sub(r"[^A-Za-z0-9_.-]", "_", db_name)
+        base = os.path.join(self.directory, safe_name)
+        return base + ".npy", base + ".json"
+
+    def put(self, db_name, ids, embeddings, documents, metadatas, generation=None):
+        """
+        Stores a replica built from index `generation`. A replica older than the current one
+        (e.g. a background load that read ChromaDB before the indexer finished) is dropped.
+        """
+        matrix = _normalize(embeddings)
+        with self._put_lock:
+            current = self.get(db_name)
+            if current is not None and is_older_generation(generation, current.generation):
+                logger.info(f"Dropping schema replica for {db_name} from generation {generation}, "
+                            f"generation {current.generation} is already loaded")
+                return current
+
+            if self.directory:
+                matrix_path, meta_path = self._paths(db_name)
+                # Write then rename, so readers never map a half-written file
+                with open(matrix_path + ".tmp", "wb") as f:
+                    np.save(f, matrix)
+                with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+                    json.dump({"ids": ids, "documents": documents, "metadatas": metadatas,
+                               "generation": generation.isoformat() if generation else None}, f)
+                os.replace(meta_path + ".tmp", meta_path)
+                os.replace(matrix_path + ".tmp", matrix_path)
+                replica = self._load(db_name) or SchemaVectorReplica(
+                    db_name, list(ids), matrix, list(documents), list(metadatas), generation=generation)
+            else:
+                replica = SchemaVectorReplica(db_name, list(ids), matrix, list(documents), list(metadatas),
+                                              generation=generation)
+
+            with self._lock:
+                self._replicas[db_name] = replica
+        logger.info(f"Schema vector replica for {db_name} refreshed: {len(replica)} vectors (generation {generation})")
+        return replica
+
+    def get(self, db_name):
+        with self._lock:
+            replica = self._replicas.get(db_name)
+        if not self.directory:
+            return replica
+
+        matrix_path, _ = self._paths(db_name)
+        try:
+            mtime = os.path.getmtime(matrix_path)
+        except OSError:
+            return replica
+        if replica is None or replica.mtime != mtime:
+            try:
+                loaded = self._load(db_name)
+            except Exception as e:
+                # Missing/corrupt metadata next to the matrix (partial copy, permissions):
+                # keep serving what we have, the caller falls back to ChromaDB if that is nothing
+                logger.error(f"Failed to load schema replica for {db_name}: {e}")
+                return replica
+            if loaded is None:
+                return replica
+            replica = loaded
+            with self._lock:
+                self._replicas[db_name] = replica
+        return replica
+
+    def _load(self, db_name):
+        matrix_path, meta_path = self._paths(db_name)
+        mtime = os.path.getmtime(matrix_path)
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        matrix = np.load(matrix_path, mmap_mode="r")
+        if matrix.shape[0] != len(meta["ids"]):
+            # Caught between the two renames of a concurrent refresh
+            logger.debug(f"Schema replica for {db_name} is being rewritten, skipping load")
+            return None
+        generation = datetime.datetime.fromisoformat(meta["generation"]) if meta.get("generation") else None
+        logger.debug(f"Loaded memory-mapped schema replica for {db_name}")
+        return SchemaVectorReplica(db_name, meta["ids"], matrix, meta["documents"], meta["metadatas"],
+                                   mtime=mtime, generation=generation)
+
+
+_replica_store = None
+_replica_store_lock = threading.Lock()
+
+
+def get_replica_store():
+    global _replica_store
+    with _replica_store_lock:
+        if _replica_store is None:
+            _replica_store = ReplicaStore()
+        return _replica_store